@@ -0,0 +1,131 @@
+"""Микробенчмарк форматирования уведомлений
+
+Запуск из корня репозитория:
+    python bench/bench_formatting.py
+    python bench/bench_formatting.py --transactions 5000 --repeat 5
+
+Сравнивает format_transaction_info с прежней реализацией (вложенная функция
+ссылок на каждый вызов, float деление суммы, strftime на каждую транзакцию).
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main.py создает монитор и хранилище при импорте - импортируем из временного каталога
+os.chdir(tempfile.mkdtemp(prefix="ton-monitor-bench-"))
+import main  # noqa: E402
+
+
+def legacy_format_transaction_info(address_book, transaction):
+    """Прежняя реализация format_transaction_info (для сравнения)"""
+    tx_type = main.TX_TYPE_LABELS[transaction.direction]
+    from_addr = transaction.source or 'Неизвестно'
+    to_addr = transaction.destination or 'Неизвестно'
+    try:
+        amount_str = f"{int(transaction.amount) / 1e9:.4f} TON"
+    except (TypeError, ValueError):
+        amount_str = f"{transaction.amount} наноТОН"
+
+    def format_address_with_link(addr):
+        if addr == 'Неизвестно':
+            return addr
+        address_info = address_book.get(addr)
+        user_friendly = address_info.get('user_friendly', addr)
+        if user_friendly.startswith('EQ'):
+            addr_type = "EQ"
+        elif user_friendly.startswith('UQ'):
+            addr_type = "UQ"
+        elif user_friendly.startswith('0:'):
+            addr_type = "RAW"
+        else:
+            addr_type = "UNK"
+        short_addr = user_friendly[:6] + "..." + user_friendly[-4:] if len(user_friendly) > 10 else user_friendly
+        domain = address_info.get('domain')
+        display_text = f"{domain} ({addr_type}:{short_addr})" if domain else f"{addr_type}:{short_addr}"
+        return f"[{display_text}](https://tonviewer.com/{user_friendly})"
+
+    message = f"""
+{tx_type}
+💎 *Сумма:* {amount_str}
+👤 *От:* {format_address_with_link(from_addr)}
+🎯 *Кому:* {format_address_with_link(to_addr)}
+⏰ *Время:* {datetime.fromtimestamp(transaction.now).strftime('%d.%m.%Y %H:%M:%S')}
+"""
+    if transaction.comment:
+        message += f"💬 *Комментарий:* {transaction.comment}\n"
+    return message.strip()
+
+
+def make_transactions(count, wallets, counterparties):
+    """Синтетические транзакции: несколько кошельков и общий набор контрагентов"""
+    now = int(datetime.now().timestamp())
+    transactions = []
+    for i in range(count):
+        wallet = random.choice(wallets)
+        counterparty = random.choice(counterparties)
+        incoming = random.random() < 0.5
+        transactions.append(main.Transaction(
+            hash=f"hash{i}",
+            lt=i,
+            now=now - random.randint(0, 3600),
+            account=wallet,
+            direction='in' if incoming else 'out',
+            amount=random.randint(1, 10 ** 15),
+            source=counterparty if incoming else wallet,
+            destination=wallet if incoming else counterparty,
+            comment=random.choice(['', 'payment_for *order* #42', 'thanks'])
+        ))
+    return transactions
+
+
+def bench(name, func, items, repeat):
+    """Лучшее время из repeat прогонов func по всем items, мкс на элемент"""
+    best = min(timeit.repeat(lambda: [func(item) for item in items], number=1, repeat=repeat))
+    per_item = best / len(items) * 1e6
+    print(f"{name:<40} {per_item:8.2f} мкс")
+    return per_item
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Микробенчмарк форматирования уведомлений")
+    parser.add_argument('--transactions', type=int, default=10000)
+    parser.add_argument('--addresses', type=int, default=500, help="Число различных контрагентов")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    monitor = main.monitor
+    wallets = [f"0:{random.getrandbits(256):064X}" for _ in range(20)]
+    counterparties = [f"0:{random.getrandbits(256):064X}" for _ in range(args.addresses)]
+    monitor.address_book.update({
+        address: {
+            'user_friendly': main.to_user_friendly(address),
+            'domain': f"user{i}.ton" if i % 5 == 0 else None
+        }
+        for i, address in enumerate(wallets + counterparties)
+    })
+    transactions = make_transactions(args.transactions, wallets, counterparties)
+
+    print(f"{args.transactions} транзакций, {args.addresses} контрагентов")
+    bench("format_amount", lambda tx: main.format_amount(tx.amount), transactions, args.repeat)
+    bench("format_time", lambda tx: main.format_time(tx.now), transactions, args.repeat)
+    bench("address_book.link", lambda tx: monitor.address_book.link(tx.source), transactions, args.repeat)
+    legacy = bench(
+        "format_transaction_info (прежняя)",
+        lambda tx: legacy_format_transaction_info(monitor.address_book, tx), transactions, args.repeat
+    )
+    current = bench("format_transaction_info", monitor.format_transaction_info, transactions, args.repeat)
+    batches = [transactions[i:i + 5] for i in range(0, len(transactions), 5)]
+    bench("render_notification (5 транзакций)", lambda txs: monitor.render_notification(txs[0].account, txs),
+          batches, args.repeat)
+    print(f"Ускорение format_transaction_info: x{legacy / current:.1f}")
+
+
+if __name__ == "__main__":
+    main_bench()
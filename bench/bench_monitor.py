@@ -0,0 +1,334 @@
+"""Нагрузочный бенчмарк мониторинга с локальными фейковыми toncenter и Telegram
+
+Запуск из корня репозитория:
+    python bench/bench_monitor.py
+    python bench/bench_monitor.py --sizes 100 1000 --duration 30 --latency 0.05 --errors 0.01 --rate-limited 0.01
+    python bench/bench_monitor.py --json results.json
+    python bench/bench_monitor.py --compare results.json  # код возврата 1 при регрессии
+
+Сеть не используется: HTTP клиенты монитора получают httpx.MockTransport,
+который обслуживает фейковый toncenter (синтетические транзакции и address_book,
+задержка, ошибки 5xx и 429) и фейковый Telegram (учет отправленных сообщений).
+Данные бота пишутся во временный каталог.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+INVOCATION_DIR = os.getcwd()
+
+# main.py создает монитор и хранилище при импорте - импортируем из временного каталога
+WORKDIR = tempfile.mkdtemp(prefix="ton-monitor-bench-")
+os.chdir(WORKDIR)
+logging.disable(logging.INFO)
+import main  # noqa: E402
+
+
+def percentile(values, q):
+    """Перцентиль q (0..100) по отсортированному списку"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def bytes_written():
+    """Байт, переданных процессом в write() (Linux), или None"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в МБ"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает КБ, macOS - байты
+    return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+class FakeToncenter:
+    """Фейковый toncenter v3: /transactions, /addressBook, /masterchainInfo"""
+    def __init__(self, latency=0.0, error_rate=0.0, rate_limit_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.transactions = {}  # raw адрес -> транзакции по возрастанию lt
+        self.created = {}  # hash -> время появления транзакции (monotonic)
+        self.lt = 1_000_000
+        self.requests = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def add_wallet(self, wallet, history=3):
+        self.transactions[wallet] = []
+        for _ in range(history):
+            self.emit(wallet)
+
+    def emit(self, wallet):
+        """Новая синтетическая входящая транзакция кошелька"""
+        self.lt += 1
+        tx_hash = f"bench{self.lt}"
+        counterparty = f"0:{random.getrandbits(256):064X}"
+        self.transactions[wallet].append({
+            'hash': tx_hash,
+            'lt': str(self.lt),
+            'now': int(time.time()),
+            'account': wallet,
+            'in_msg': {
+                'source': counterparty,
+                'destination': wallet,
+                'value': str(random.randint(1, 10**12)),
+                'message_content': {'decoded': {'type': 'text_comment', 'comment': 'bench'}}
+            },
+            'out_msgs': []
+        })
+        self.created[tx_hash] = time.monotonic()
+
+    def address_book(self, addresses):
+        return {
+            address: {'user_friendly': main.to_user_friendly(address), 'domain': None}
+            for address in addresses if address.startswith('0:')
+        }
+
+    def list_transactions(self, params):
+        accounts = params.get_list('account')
+        start_lt = int(params.get('start_lt', 0))
+        start_utime = int(params.get('start_utime', 0))
+        limit = int(params.get('limit', 10))
+        offset = int(params.get('offset', 0))
+
+        selected = [
+            tx for account in accounts for tx in self.transactions.get(account, ())
+            if int(tx['lt']) >= start_lt and tx['now'] >= start_utime
+        ]
+        selected.sort(key=lambda tx: int(tx['lt']), reverse=params.get('sort') == 'desc')
+        page = selected[offset:offset + limit]
+        addresses = {tx['account'] for tx in page} | {tx['in_msg']['source'] for tx in page}
+        return {'transactions': page, 'address_book': self.address_book(addresses)}
+
+    async def handle(self, request):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            self.rate_limited += 1
+            return httpx.Response(429, headers={'Retry-After': '1'}, json={'error': 'rate limit'})
+        if roll < self.rate_limit_rate + self.error_rate:
+            self.errors += 1
+            return httpx.Response(502, json={'error': 'bad gateway'})
+
+        path = request.url.path
+        if path.endswith(main.TRANSACTIONS_PATH):
+            return httpx.Response(200, json=self.list_transactions(request.url.params))
+        if path.endswith(main.ADDRESS_BOOK_PATH):
+            return httpx.Response(200, json=self.address_book(request.url.params.get_list('address')))
+        if path.endswith(main.MASTERCHAIN_INFO_PATH):
+            return httpx.Response(200, json={'last': {'seqno': 1}})
+        return httpx.Response(404, json={'error': 'not found'})
+
+
+class FakeTelegram:
+    """Фейковый Bot API: принимает sendMessage и учитывает доставленные сообщения"""
+    def __init__(self, latency=0.0, rate_limit_rate=0.0):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.delivered = []  # время доставки (monotonic)
+        self.rate_limited = 0
+
+    async def handle(self, request):
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            return httpx.Response(429, json={'ok': False, 'parameters': {'retry_after': 1}})
+        self.delivered.append(time.monotonic())
+        return httpx.Response(200, json={'ok': True, 'result': {}})
+
+
+def configure(args):
+    """Настройки main.py для прогона"""
+    main.TON_API_ENDPOINTS = [{'url': main.TON_API_BASE, 'api_key': None, 'rps': args.rps}]
+    # TonApiClient читает POLL_CONCURRENCY при создании, пул соединений - TON_POOL_SIZE
+    main.POLL_CONCURRENCY = args.concurrency
+    main.TON_POOL_SIZE = args.concurrency
+    main.POLL_INTERVAL = args.interval
+    main.ADAPTIVE_POLLING = args.engine == 'adaptive'
+    main.MONITOR_ENGINE = 'poll'
+    main.STORAGE_BACKEND = args.storage
+    main.PERSIST_INTERVAL = 1
+
+
+async def run_scenario(size, args):
+    """Один прогон: холодный и теплый проход по всем кошелькам, затем работа под нагрузкой"""
+    scenario_dir = tempfile.mkdtemp(prefix=f"wallets-{size}-", dir=WORKDIR)
+    os.chdir(scenario_dir)
+
+    toncenter = FakeToncenter(args.latency, args.errors, args.rate_limited)
+    telegram = FakeTelegram(args.telegram_latency)
+
+    async def handler(request):
+        if request.url.host == 'api.telegram.org':
+            return await telegram.handle(request)
+        return await toncenter.handle(request)
+
+    monitor = main.WalletMonitor()
+    main.monitor = monitor
+    monitor.transport = main.HttpTransport(transport=httpx.MockTransport(handler))
+    monitor.scheduler = main.PollScheduler(min_interval=args.interval, max_interval=args.interval * 4)
+
+    wallets = [f"0:{random.getrandbits(256):064X}" for _ in range(size)]
+    for i, wallet in enumerate(wallets):
+        toncenter.add_wallet(wallet)
+        monitor.add_wallet(str(i % args.chats), wallet, 'private')
+    monitor.storage.flush()
+
+    detected = {}
+    process = monitor.process_transactions_for_wallet
+
+    def track(wallet, transactions, policy='notify'):
+        now = time.monotonic()
+        for tx in transactions:
+            detected.setdefault(tx.hash, now)
+        return process(wallet, transactions, policy)
+    monitor.process_transactions_for_wallet = track
+
+    written_before = bytes_written()
+    monitor.reset_api_limits()
+    assert monitor.api.concurrency == args.concurrency
+    await monitor.transport.start()
+    try:
+        started = time.monotonic()
+        await monitor.check_transactions_async(monitor.transport.toncenter)
+        sweep_cold = time.monotonic() - started
+
+        started = time.monotonic()
+        await monitor.check_transactions_async(monitor.transport.toncenter)
+        sweep_warm = time.monotonic() - started
+    finally:
+        await monitor.transport.close()
+
+    # Работа под нагрузкой: полный цикл мониторинга и доставки
+    emitted = []
+    requests_before = toncenter.requests
+    loop_task = asyncio.create_task(main.monitor_loop())
+    load_started = time.monotonic()
+    deadline = load_started + args.duration
+    while time.monotonic() < deadline:
+        for wallet in random.sample(wallets, min(len(wallets), args.tx_rate)):
+            toncenter.emit(wallet)
+            emitted.append(toncenter.transactions[wallet][-1]['hash'])
+        await asyncio.sleep(1)
+    # Даем догнать транзакции последней секунды
+    await asyncio.sleep(args.interval)
+    loop_task.cancel()
+    await asyncio.gather(loop_task, return_exceptions=True)
+    elapsed = time.monotonic() - load_started
+    monitor.storage.close()
+    written_after = bytes_written()
+
+    latencies = sorted(detected[h] - toncenter.created[h] for h in emitted if h in detected)
+    return {
+        'wallets': size,
+        'sweep_cold_s': round(sweep_cold, 3),
+        'sweep_warm_s': round(sweep_warm, 3),
+        'emitted': len(emitted),
+        'detected': len(latencies),
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p95_s': percentile(latencies, 95),
+        'latency_p99_s': percentile(latencies, 99),
+        'notifications': len(telegram.delivered),
+        'notifications_per_s': round(len(telegram.delivered) / elapsed, 2),
+        'api_requests_per_s': round((toncenter.requests - requests_before) / elapsed, 2),
+        'api_errors': toncenter.errors,
+        'api_rate_limited': toncenter.rate_limited,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'bytes_written': None if written_before is None else written_after - written_before,
+    }
+
+
+def print_results(results):
+    columns = list(results[0])
+    print(' | '.join(columns))
+    for result in results:
+        print(' | '.join(
+            f"{value:.3f}" if isinstance(value, float) else str(value) for value in result.values()
+        ))
+
+
+def compare(results, baseline_path, tolerance):
+    """Сравнение с сохраненным прогоном; возвращает список регрессий"""
+    with open(baseline_path) as f:
+        baseline = {result['wallets']: result for result in json.load(f)}
+    regressions = []
+    for result in results:
+        base = baseline.get(result['wallets'])
+        if not base:
+            continue
+        for key in ('sweep_cold_s', 'sweep_warm_s', 'latency_p95_s', 'peak_rss_mb', 'bytes_written'):
+            if base.get(key) and result.get(key) is not None and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{result['wallets']} кошельков: {key} {base[key]} -> {result[key]}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Бенчмарк мониторинга TON кошельков")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help="Число кошельков в прогонах")
+    parser.add_argument('--duration', type=float, default=30, help="Длительность работы под нагрузкой (сек)")
+    parser.add_argument('--tx-rate', type=int, default=20, help="Новых транзакций в секунду")
+    parser.add_argument('--interval', type=float, default=5, help="Интервал опроса (сек)")
+    parser.add_argument('--engine', choices=['poll', 'adaptive'], default='adaptive')
+    parser.add_argument('--storage', choices=['sqlite', 'json'], default=main.STORAGE_BACKEND)
+    parser.add_argument('--rps', type=float, default=1000, help="Лимит запросов к фейковому toncenter")
+    parser.add_argument('--concurrency', type=int, default=main.POLL_CONCURRENCY)
+    parser.add_argument('--chats', type=int, default=100, help="Число чатов-подписчиков")
+    parser.add_argument('--latency', type=float, default=0.02, help="Задержка ответа toncenter (сек)")
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="Задержка ответа Telegram (сек)")
+    parser.add_argument('--errors', type=float, default=0.0, help="Доля ответов 5xx")
+    parser.add_argument('--rate-limited', type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument('--json', help="Сохранить результаты в файл")
+    parser.add_argument('--compare', help="Сравнить с результатами из файла")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Допустимое ухудшение при сравнении")
+    return parser.parse_args()
+
+
+def main_bench():
+    args = parse_args()
+    configure(args)
+
+    results = []
+    for size in args.sizes:
+        print(f"Прогон: {size} кошельков...", file=sys.stderr)
+        results.append(asyncio.run(run_scenario(size, args)))
+    print_results(results)
+
+    if args.json:
+        with open(os.path.join(INVOCATION_DIR, args.json), 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        regressions = compare(results, os.path.join(INVOCATION_DIR, args.compare), args.tolerance)
+        for regression in regressions:
+            print(f"Регрессия: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_bench()
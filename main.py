@@ -1,12 +1,25 @@
+import base64
+import bisect
+import hashlib
 import json
+import os
+import random
+import sqlite3
+import sys
 import time
 import requests
 import asyncio
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
+import httpx
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes, MessageHandler, filters
+from dataclasses import dataclass
 from datetime import datetime
 import logging
 import threading
+import heapq
+from collections import OrderedDict, deque
+from functools import lru_cache
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,58 +35,2167 @@ BOT_TOKEN = "7527777777:AAEbOccccbEZc1ck.........."
 WALLETS_FILE = "look_wallet.json"
 LAST_TX_FILE = "last_transactions.json"
 SETTINGS_FILE = "chat_settings.json"
+CURSORS_FILE = "wallet_cursors.json"
+ADDRESS_BOOK_FILE = "address_book.json"
+DB_FILE = "monitor.db"
+BROKER_FILE = "broker.db"
+
+# Хранилище данных: 'sqlite' (построчные изменения, WAL) или 'json' (файлы целиком)
+# При первом запуске с пустой базой SQLite данные переносятся из JSON файлов
+STORAGE_BACKEND = 'sqlite'
+MAX_STORED_TRANSACTIONS = 50  # Сколько последних транзакций хранить по кошельку
+PERSIST_INTERVAL = 5  # JSON: изменения накапливаются и записываются не чаще раза в N секунд и при остановке
+
+ADDRESS_CACHE_SIZE = 100_000  # Размер LRU кэша преобразований адресов
+ADDRESS_BOOK_TTL = 24 * 3600  # Время жизни user-friendly формы и домена адреса (секунды)
+ADDRESS_BOOK_MAX_SIZE = 50_000  # Адресов в кэше address_book (вытесняются давно неиспользуемые)
+
+# Подписи типов транзакций
+TX_TYPE_LABELS = {
+    'in': "📥 Входящая",
+    'out': "📤 Исходящая",
+    'other': "🔁 Другая",
+}
+
+# Jetton и NFT: opcode сообщений (TEP-74, TEP-62) и подписи декодированных переводов
+OP_JETTON_TRANSFER = 0x0f8a7ea5
+OP_JETTON_NOTIFY = 0x7362d09c
+OP_JETTON_BURN = 0x595f07bc
+OP_NFT_TRANSFER = 0x5fcc3d14
+OP_NFT_OWNERSHIP_ASSIGNED = 0x05138d91
+TX_KIND_LABELS = {
+    ('jetton', 'in'): "🪙 Входящий перевод токенов",
+    ('jetton', 'out'): "🪙 Исходящий перевод токенов",
+    ('jetton_burn', 'out'): "🔥 Сжигание токенов",
+    ('nft', 'in'): "🖼 Получен NFT",
+    ('nft', 'out'): "🖼 Отправлен NFT",
+}
+JETTON_CACHE_SIZE = 10_000  # Jetton кошельков и мастеров в кэше метаданных (вытесняются давно неиспользуемые)
+UNVERIFIED_JETTON_LABEL = "⚠️ неподтвержденный токен"
+
+# Фильтры уведомлений подписки (чат, кошелек): /filter
+FILTER_MAX_KEYWORDS = 20  # Ключевых слов комментария в одном фильтре
+FILTER_KEYWORD_MAX_LENGTH = 100
+FILTER_COMMENT_SCAN_LENGTH = 1000  # Сколько первых символов комментария проверяется на ключевые слова
+FILTER_DIRECTIONS = {'in': "только входящие", 'out': "только исходящие"}
+
+# Уведомления и режим сводки (/digest): события всех кошельков чата объединяются в одно сообщение
+NOTIFICATION_MAX_TRANSACTIONS = 5  # Транзакций в уведомлении по кошельку (остальные - счетчиком)
+DIGEST_MAX_WINDOW = 24 * 60  # Максимальное окно сводки (минуты)
+DIGEST_MAX_EVENTS = 100  # Сводка отправляется досрочно, когда накопилось столько транзакций
+DIGEST_WALLET_LATEST = 3  # Транзакций по каждому кошельку в сводке
+DIGEST_CHECK_INTERVAL = 1  # Проверка истекших окон (секунды)
+
+# /lasttransactions: постраничный вывод с кнопками
+LAST_TX_PAGE_SIZE = 10  # Кошельков на странице
+LAST_TX_PER_WALLET = 3  # Транзакций по каждому кошельку
+TELEGRAM_MESSAGE_LIMIT = 4096
+LAST_TX_HEADER_RESERVE = 64  # Место под заголовок страницы с номером
+
+# Форматирование уведомлений
+NANOTON = 10 ** 9
+DISPLAY_TIMEZONE = None  # Часовой пояс времени транзакций, например ZoneInfo('Europe/Moscow'); None - пояс сервера
+TIME_FORMAT = '%d.%m.%Y %H:%M:%S'
+TIME_FORMAT_CACHE_SIZE = 65_536
+TRANSACTION_TEMPLATE = (
+    "{label}\n"
+    "💎 *Сумма:* {amount}\n"
+    "👤 *От:* {source}\n"
+    "🎯 *Кому:* {destination}\n"
+    "⏰ *Время:* {time}"
+).format
+COMMENT_TEMPLATE = "\n💬 *Комментарий:* {}".format
+ADDRESS_LINK_TEMPLATE = "[{text}](https://tonviewer.com/{address})".format
+# Экранирование пользовательского текста для parse_mode='Markdown'
+MARKDOWN_ESCAPE = str.maketrans({'_': '\\_', '*': '\\*', '`': '\\`', '[': '\\['})
 
 # API URLs
-TON_API_URL = "https://toncenter.com/api/v3/transactions"
+TON_API_BASE = "https://toncenter.com/api/v3"
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+TON_API_KEY = ""  # Ключ toncenter (пусто - работа без ключа)
 API_HEADERS = {'accept': 'application/json'}
 
-class WalletMonitor:
+# Методы API v3 (относительно адреса эндпоинта)
+TRANSACTIONS_PATH = "/transactions"
+MASTERCHAIN_INFO_PATH = "/masterchainInfo"
+BLOCK_TRANSACTIONS_PATH = "/transactionsByMasterchainBlock"
+ADDRESS_BOOK_PATH = "/addressBook"
+ADDRESS_BOOK_BATCH = 100  # Адресов в одном запросе addressBook
+JETTON_WALLETS_PATH = "/jetton/wallets"
+JETTON_MASTERS_PATH = "/jetton/masters"
+
+# Параметры опроса API
+# Лимит toncenter: без ключа 1 запрос/сек, с бесплатным ключом 10 запросов/сек
+TON_API_RPS = 10 if TON_API_KEY else 1
+
+# Эндпоинты API v3 (toncenter с разными ключами, собственный индексатор и т.д.)
+# Запросы распределяются между доступными эндпоинтами с учетом их лимита и состояния
+TON_API_ENDPOINTS = [
+    {'url': TON_API_BASE, 'api_key': TON_API_KEY, 'rps': TON_API_RPS},
+    # {'url': "http://127.0.0.1:8081/api/v3", 'api_key': "", 'rps': 100},
+]
+
+# Повторы и автоматический выключатель (circuit breaker)
+API_MAX_RETRIES = 3  # Повторов одного запроса (на любом из эндпоинтов)
+API_BACKOFF_BASE = 0.5  # Начальная задержка повтора (секунды), растет экспоненциально
+API_BACKOFF_MAX = 30
+BREAKER_FAILURE_THRESHOLD = 5  # Ошибок подряд до отключения эндпоинта
+BREAKER_RESET_TIMEOUT = 30  # Через сколько секунд пробовать отключенный эндпоинт снова
+POLL_CONCURRENCY = 10  # Максимум одновременных запросов к API
+POLL_INTERVAL = 120  # Интервал между проверками (секунды)
+TX_PAGE_LIMIT = 100  # Размер страницы при догоняющей загрузке транзакций
+
+# Адаптивный опрос: у каждого кошелька свой интервал, сокращается при активности
+# и растет экспоненциально, пока кошелек простаивает
+ADAPTIVE_POLLING = True
+POLL_MIN_INTERVAL = 15  # Интервал для активных кошельков (секунды)
+POLL_MAX_INTERVAL = 600  # Предельный интервал для неактивных кошельков (секунды)
+POLL_BACKOFF = 2  # Множитель интервала после проверки без новых транзакций
+
+# Пакетный режим: один запрос на группу кошельков вместо запроса на каждый
+BATCH_POLLING = False
+POLL_BATCH_SIZE = 50  # Кошельков в одном запросе
+BATCH_TIME_OVERLAP = 60  # Запас по времени (сек) при запросе по start_utime
+
+# Движок мониторинга: 'poll' - опрос кошельков, 'blocks' - сканирование новых блоков мастерчейна
+MONITOR_ENGINE = 'poll'
+BLOCK_POLL_INTERVAL = 3  # Проверка новых блоков (секунды, ~время блока)
+MAX_BLOCK_CATCHUP = 50  # При большем отставании догоняем опросом кошельков по курсорам
+API_TIMEOUT = 30
+
+# Транзакции, пришедшие пока бот был выключен, догоняются по курсорам кошельков
+CATCHUP_POLICY = 'notify'  # 'notify' - как обычно, 'summary' - одна сводка на кошелек, 'skip' - без уведомлений
+CATCHUP_SUMMARY_LATEST = 3  # Сколько последних транзакций показывать в сводке
+
+# Шардированный режим: кошельки распределяются по процессам-воркерам (python main.py --worker ID)
+# консистентным хешированием, бот только рассылает их уведомления. Требует STORAGE_BACKEND = 'sqlite'
+SHARDING_ENABLED = False
+HASH_RING_REPLICAS = 64  # Виртуальных узлов на воркер
+WORKER_HEARTBEAT = 10  # Как часто воркер отмечается в брокере и обновляет свой шард (секунды)
+WORKER_TIMEOUT = 30  # Воркер без отметок дольше этого считается выбывшим
+BROKER_POLL_INTERVAL = 1  # Опрос очереди уведомлений ботом (секунды)
+BROKER_BATCH = 100  # Уведомлений из очереди за раз
+BROKER_DEDUP_WINDOW = 3600  # Сколько хранить доставленные уведомления для отсева дублей (секунды)
+
+# Доставка уведомлений в Telegram
+TELEGRAM_GLOBAL_RPS = 30  # Общий лимит Telegram: ~30 сообщений в секунду
+TELEGRAM_PRIVATE_INTERVAL = 1.0  # Не чаще 1 сообщения в секунду в личный чат
+TELEGRAM_GROUP_INTERVAL = 3.0  # Группы: не более 20 сообщений в минуту
+DELIVERY_WORKERS = 8  # Количество параллельных отправителей
+DELIVERY_MAX_RETRIES = 5  # Повторы при сетевых ошибках, 429 и 5xx
+DELIVERY_DRAIN_TIMEOUT = 30  # Сколько секунд при остановке доотправлять очередь (курсоры уже сохранены)
+
+# HTTP транспорт (общие пулы соединений для toncenter и Telegram)
+HTTP2_ENABLED = True  # Нужен пакет h2 (pip install httpx[http2]), без него - HTTP/1.1
+TON_POOL_SIZE = POLL_CONCURRENCY  # Соединений к toncenter
+TELEGRAM_POOL_SIZE = DELIVERY_WORKERS  # Соединений к Telegram
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_KEEPALIVE_EXPIRY = 120  # Сколько держать простаивающее соединение (секунды)
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+# (у воркеров - свой порт: --metrics-port или METRICS_PORT + 1 + числовой ID воркера)
+METRICS_ENABLED = True
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LOG_SAMPLE_RATE = 0.01  # Доля событий по отдельным кошелькам, попадающих в DEBUG лог
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import orjson
+    
+    def json_dumps(data):
+        return orjson.dumps(data)
+except ImportError:
+    def json_dumps(data):
+        """Компактная сериализация в JSON (bytes)"""
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Реестр метрик: счетчики, гистограммы и gauge-функции в формате Prometheus"""
     def __init__(self):
-        self.wallets = self.load_wallets()
-        self.last_transactions = self.load_last_transactions()
-        self.chat_settings = self.load_chat_settings()
-        self.bot_start_time = datetime.now()
-        self.first_run = True  # Флаг первого запуска
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.gauges = {}  # имя -> функция без аргументов
+    
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, value, labels=()):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+    
+    def gauge(self, name, func):
+        self.gauges[name] = func
+    
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+    
+    def render(self):
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def debug_sampled():
+    """Писать ли в DEBUG лог событие по отдельному кошельку (выборка LOG_SAMPLE_RATE)"""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE
+
+
+async def handle_metrics_request(reader, writer):
+    """Минимальный HTTP обработчик: GET /metrics"""
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if request_line.split(b' ')[1:2] == [b'/metrics']:
+            status, body = b'200 OK', metrics.render().encode()
+        else:
+            status, body = b'404 Not Found', b'Not Found\n'
+        writer.write(
+            b'HTTP/1.1 ' + status + b'\r\n'
+            b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+            b'Connection: close\r\n\r\n' + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Ошибка запроса метрик: {e}")
+    finally:
+        writer.close()
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов по алгоритму token bucket"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Ожидание свободного токена"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class CircuitBreaker:
+    """Автоматический выключатель: после серии ошибок запросы сразу отклоняются
+    
+    closed - запросы идут, open - отклоняются до истечения reset_timeout,
+    half_open - пропускается один пробный запрос.
+    """
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = 'closed'
+        self.opened_at = 0
+    
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = 'half_open'
+            return True
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.state = 'closed'
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.failure_threshold:
+            if self.state != 'open':
+                logger.warning(f"Эндпоинт отключен на {self.reset_timeout} сек после {self.failures} ошибок")
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+    
+    def settle(self):
+        """Пробный запрос завершился без оценки (отмена, исключение) - снова отключаем до reset_timeout"""
+        if self.state == 'half_open':
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+
+
+class ApiEndpoint:
+    """Эндпоинт API со своим лимитом запросов, выключателем и оценкой состояния"""
+    def __init__(self, url, api_key="", rps=1):
+        self.url = url.rstrip('/')
+        self.headers = {'X-API-Key': api_key} if api_key else {}
+        self.rps = rps
+        self.rate_limiter = TokenBucket(rps)
+        self.breaker = CircuitBreaker()
+        self.health = 1.0  # Скользящая доля успешных запросов
+    
+    @property
+    def weight(self):
+        # Минимальный вес, чтобы восстановившийся эндпоинт снова получал запросы
+        return self.rps * max(self.health, 0.05)
+    
+    def record(self, success):
+        self.health = self.health * 0.8 + (0.2 if success else 0)
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+
+class TonApiClient:
+    """Клиент API v3 с повторами, выключателями и переключением между эндпоинтами
+    
+    Запрос уходит на эндпоинт, выбранный случайно с весом rps * health среди
+    тех, чей выключатель пропускает запросы. При ошибке сети, 429 или 5xx
+    запрос повторяется с экспоненциальной задержкой и разбросом, обычно уже
+    на другом эндпоинте. Если все эндпоинты отключены, запрос сразу завершается
+    неудачей.
+    """
+    def __init__(self, endpoints=None, concurrency=None):
+        # Настройки читаются при создании клиента, а не при импорте (их меняют бенчмарки)
+        self.endpoints = [ApiEndpoint(**endpoint) for endpoint in (endpoints or TON_API_ENDPOINTS)]
+        self.concurrency = concurrency or POLL_CONCURRENCY
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+    
+    def choose_endpoint(self):
+        available = [endpoint for endpoint in self.endpoints if endpoint.breaker.allow()]
+        if not available:
+            return None
+        return random.choices(available, weights=[endpoint.weight for endpoint in available])[0]
+    
+    async def get(self, client, path, params):
+        """GET запрос; возвращает JSON ответа или None при неудаче"""
+        for attempt in range(API_MAX_RETRIES + 1):
+            endpoint = self.choose_endpoint()
+            if endpoint is None:
+                logger.error("Все эндпоинты API недоступны")
+                return None
+            
+            retry_after = None
+            try:
+                async with self.semaphore:
+                    await endpoint.rate_limiter.acquire()
+                    started = time.monotonic()
+                    response = await client.get(endpoint.url + path, params=params, headers=endpoint.headers)
+                metrics.observe('ton_monitor_api_request_seconds', time.monotonic() - started, (('path', path),))
+                metrics.inc('ton_monitor_api_responses_total', (('path', path), ('status', str(response.status_code))))
+                
+                if response.status_code == 200:
+                    endpoint.record(True)
+                    return response.json()
+                
+                if response.status_code == 429:
+                    # Превышен лимит - эндпоинт жив, но его вес временно снижаем
+                    endpoint.breaker.record_success()
+                    endpoint.health *= 0.5
+                    try:
+                        retry_after = float(response.headers.get('Retry-After', 0))
+                    except ValueError:
+                        retry_after = None
+                elif response.status_code >= 500:
+                    endpoint.record(False)
+                else:
+                    # Ошибка запроса: эндпоинт жив, но повтор не поможет
+                    endpoint.breaker.record_success()
+                    logger.error(f"Ошибка API {endpoint.url}: {response.status_code}")
+                    return None
+                logger.warning(f"Ошибка API {endpoint.url}: {response.status_code}")
+            except httpx.HTTPError as e:
+                endpoint.record(False)
+                metrics.inc('ton_monitor_api_responses_total', (('path', path), ('status', 'error')))
+                logger.warning(f"Ошибка запроса к {endpoint.url}: {e!r}")
+            finally:
+                # Пробный запрос всегда переводит выключатель в closed или open
+                endpoint.breaker.settle()
+            
+            if attempt < API_MAX_RETRIES:
+                delay = min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt)
+                delay = max(delay * random.uniform(0.5, 1.5), retry_after or 0)
+                await asyncio.sleep(delay)
+        
+        logger.error(f"Запрос {path} не выполнен после {API_MAX_RETRIES + 1} попыток")
+        return None
+
+
+class PollScheduler:
+    """Расписание опроса кошельков на основе очереди с приоритетом
+    
+    Для каждого кошелька хранится свой интервал и время следующей проверки.
+    Новые кошельки начинают с POLL_INTERVAL. После проверки с новыми транзакциями
+    интервал сбрасывается до минимального, после проверки без них - умножается
+    на POLL_BACKOFF до POLL_MAX_INTERVAL.
+    """
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL, backoff=POLL_BACKOFF):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.initial_interval = min(max(POLL_INTERVAL, min_interval), max_interval)
+        self.backoff = backoff
+        self.heap = []  # (время проверки, кошелек)
+        self.next_poll = {}  # кошелек -> актуальное время проверки
+        self.intervals = {}  # кошелек -> текущий интервал
+        self.added = deque()  # Новые кошельки из обработчиков команд
+    
+    def add(self, wallet, when=None):
+        """Добавление кошелька в расписание (по умолчанию - проверить сразу)"""
+        when = time.monotonic() if when is None else when
+        self.intervals.setdefault(wallet, self.initial_interval)
+        self.next_poll[wallet] = when
+        heapq.heappush(self.heap, (when, wallet))
+    
+    def remove(self, wallet):
+        """Исключение кошелька из расписания"""
+        self.next_poll.pop(wallet, None)
+        self.intervals.pop(wallet, None)
+    
+    def sync(self, wallets):
+        """Учет новых кошельков и удаление исчезнувших"""
+        while self.added:
+            wallet = self.added.popleft()
+            if wallet not in self.next_poll:
+                self.add(wallet)
+        if len(wallets) == len(self.next_poll):
+            return
+        # Полная сверка - только если набор кошельков изменился
+        for wallet in wallets:
+            if wallet not in self.next_poll:
+                self.add(wallet)
+        for wallet in [w for w in self.next_poll if w not in wallets]:
+            self.remove(wallet)
+    
+    def pop_due(self, now):
+        """Кошельки, время проверки которых наступило"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, wallet = heapq.heappop(self.heap)
+            # Записи удаленных и перепланированных кошельков пропускаем
+            if self.next_poll.get(wallet) == when:
+                due.append(wallet)
+        return due
+    
+    def reschedule(self, wallet, active, now):
+        """Планирование следующей проверки после текущей"""
+        if wallet not in self.next_poll:
+            return
+        if active:
+            interval = self.min_interval
+        else:
+            interval = min(self.intervals.get(wallet, self.initial_interval) * self.backoff, self.max_interval)
+        self.intervals[wallet] = interval
+        self.add(wallet, now + interval)
+    
+    def time_to_next(self, now):
+        """Сколько ждать до ближайшей проверки"""
+        if not self.heap:
+            return self.min_interval
+        return max(0, self.heap[0][0] - now)
+    
+    def stats(self):
+        """Распределение интервалов опроса"""
+        intervals = sorted(self.intervals.values())
+        if not intervals:
+            return {'wallets': 0}
+        return {
+            'wallets': len(intervals),
+            'min': intervals[0],
+            'median': intervals[len(intervals) // 2],
+            'max': intervals[-1],
+            'active': sum(1 for i in intervals if i <= self.min_interval),
+        }
+
+
+class HttpTransport:
+    """Долгоживущие HTTP клиенты с пулом соединений, keep-alive и HTTP/2
+    
+    Один клиент для toncenter (используется опросом) и один для Telegram
+    (используется очередью доставки). Клиенты привязаны к циклу событий,
+    в котором вызван start().
+    """
+    def __init__(self, transport=None):
+        self.transport = transport  # Подмена транспорта httpx (для тестов и бенчмарков)
+        self.toncenter = None
+        self.telegram = None
+        self.session = None
+    
+    def create_client(self, pool_size, headers=None):
+        """Асинхронный клиент с пулом на pool_size соединений"""
+        return httpx.AsyncClient(
+            headers=headers,
+            http2=HTTP2_ENABLED and HTTP2_AVAILABLE,
+            transport=self.transport,
+            timeout=httpx.Timeout(API_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            )
+        )
+    
+    async def start(self):
+        self.toncenter = self.create_client(TON_POOL_SIZE, API_HEADERS)  # Ключи - по эндпоинтам
+        self.telegram = self.create_client(TELEGRAM_POOL_SIZE)
+    
+    async def close(self):
+        for client in (self.toncenter, self.telegram):
+            if client is not None:
+                await client.aclose()
+        self.toncenter = self.telegram = None
+    
+    def sync_session(self):
+        """Синхронная сессия requests с пулом соединений (для отправки вне цикла событий)"""
+        if self.session is None:
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_POOL_SIZE)
+            self.session.mount('https://', adapter)
+        return self.session
+
+
+class TelegramNotifier:
+    """Очередь доставки сообщений в Telegram с асинхронными отправителями
+    
+    У каждого чата своя очередь сообщений, чат в каждый момент обслуживает
+    не больше одного отправителя - так сохраняется порядок сообщений и лимит
+    на чат. Общий лимит Telegram соблюдается через token bucket. На 429
+    учитывается retry_after, на сетевые ошибки и 5xx - повтор с экспоненциальной
+    задержкой.
+    """
+    def __init__(self):
+        self.loop = None
+        self.ready = None  # Очередь чатов, готовых к отправке
+        self.client = None
+        self.workers = []
+        self.rate_limiter = None
+        self.pending = {}  # chat_id -> deque[(текст, номер попытки, время постановки)]
+    
+    @property
+    def running(self):
+        return self.loop is not None
+    
+    async def start(self, client):
+        """Запуск отправителей в текущем цикле событий с общим клиентом Telegram"""
+        self.loop = asyncio.get_running_loop()
+        self.ready = asyncio.Queue()
+        self.rate_limiter = TokenBucket(TELEGRAM_GLOBAL_RPS)
+        self.client = client
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(DELIVERY_WORKERS)]
+        logger.info(f"Доставка уведомлений запущена ({DELIVERY_WORKERS} отправителей)")
+    
+    async def stop(self, timeout=DELIVERY_DRAIN_TIMEOUT):
+        """Остановка отправителей после доотправки очереди, но не дольше timeout секунд
+        
+        Курсоры транзакций из очереди уже сохранены, поэтому после перезапуска
+        эти уведомления не повторятся.
+        """
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.pending:
+            lost = self.queue_size()
+            metrics.inc('ton_monitor_telegram_sends_total', (('outcome', 'dropped'),), lost)
+            logger.error(f"Остановка: не доставлено {lost} сообщений в {len(self.pending)} чатов")
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.loop = None
     
-    def load_wallets(self):
-        """Загрузка списка кошельков из файла"""
+    def enqueue(self, chat_id, text):
+        """Постановка сообщения в очередь (из цикла событий, в котором работают отправители)"""
+        self.push(str(chat_id), text)
+    
+    def push(self, chat_id, text):
+        queue = self.pending.get(chat_id)
+        if queue is None:
+            # Чат не обслуживается - ставим его в очередь готовых
+            self.pending[chat_id] = deque([(text, 0, time.monotonic())])
+            self.ready.put_nowait(chat_id)
+        else:
+            queue.append((text, 0, time.monotonic()))
+    
+    def queue_size(self):
+        """Количество сообщений, ожидающих отправки"""
+        return sum(len(queue) for queue in self.pending.values())
+    
+    def chat_interval(self, chat_id):
+        # Отрицательные chat_id - группы и каналы
+        return TELEGRAM_GROUP_INTERVAL if chat_id.startswith('-') else TELEGRAM_PRIVATE_INTERVAL
+    
+    async def worker(self):
+        while True:
+            chat_id = await self.ready.get()
+            queue = self.pending[chat_id]
+            text, attempt, enqueued = queue[0]
+            delay = self.chat_interval(chat_id)
+            try:
+                await self.rate_limiter.acquire()
+                retry_delay = await self.send(chat_id, text, attempt)
+                if retry_delay is None:
+                    queue.popleft()
+                    metrics.observe('ton_monitor_delivery_latency_seconds', time.monotonic() - enqueued)
+                else:
+                    queue[0] = (text, attempt + 1, enqueued)
+                    delay = max(delay, retry_delay)
+            except Exception as e:
+                logger.error(f"Ошибка доставки в чат {chat_id}: {e}")
+                queue.popleft()
+            
+            if queue:
+                # Следующее сообщение чата - не раньше, чем позволяет лимит чата
+                self.loop.call_later(delay, self.ready.put_nowait, chat_id)
+            else:
+                del self.pending[chat_id]
+    
+    async def send(self, chat_id, text, attempt):
+        """Отправка одного сообщения
+        
+        Возвращает None, если сообщение доставлено или повторять бессмысленно,
+        иначе - задержку перед повтором.
+        """
+        payload = {
+            'chat_id': chat_id,
+            'text': text,
+            'parse_mode': 'Markdown',
+            'disable_web_page_preview': True
+        }
+        
+        retry_after = None
         try:
-            with open(WALLETS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            return {}
+            response = await self.client.post(TELEGRAM_API_URL, json=payload)
+            if response.status_code == 200:
+                metrics.inc('ton_monitor_telegram_sends_total', (('outcome', 'ok'),))
+                if debug_sampled():
+                    logger.debug(f"Уведомление отправлено в чат {chat_id}")
+                return None
+            
+            if response.status_code == 429:
+                metrics.inc('ton_monitor_telegram_sends_total', (('outcome', 'rate_limited'),))
+                try:
+                    retry_after = response.json().get('parameters', {}).get('retry_after')
+                except ValueError:
+                    pass
+                retry_after = retry_after or 1
+            elif response.status_code < 500:
+                # Ошибки запроса (чат не найден, бот заблокирован, разметка) повтором не исправить
+                metrics.inc('ton_monitor_telegram_sends_total', (('outcome', 'rejected'),))
+                logger.error(f"Ошибка отправки в чат {chat_id}: {response.status_code} - {response.text}")
+                return None
+            else:
+                metrics.inc('ton_monitor_telegram_sends_total', (('outcome', 'server_error'),))
+                logger.warning(f"Ошибка Telegram для чата {chat_id}: {response.status_code}")
+        except httpx.HTTPError as e:
+            metrics.inc('ton_monitor_telegram_sends_total', (('outcome', 'network_error'),))
+            logger.warning(f"Ошибка соединения с Telegram для чата {chat_id}: {e}")
+        
+        if attempt >= DELIVERY_MAX_RETRIES:
+            metrics.inc('ton_monitor_telegram_sends_total', (('outcome', 'dropped'),))
+            logger.error(f"Сообщение в чат {chat_id} не доставлено после {attempt + 1} попыток")
+            return None
+        
+        if retry_after is not None:
+            logger.warning(f"Лимит Telegram для чата {chat_id}, повтор через {retry_after} сек")
+            return retry_after
+        return min(60, 2 ** attempt) + random.uniform(0, 1)
+
+
+def crc16(data):
+    """CRC16-XMODEM, используется в user-friendly адресах TON"""
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+            crc &= 0xFFFF
+    return crc
+
+
+def parse_address(address):
+    """Разбор адреса TON в raw (0:hex) или user-friendly (base64/base64url) форме
+    
+    Возвращает (workchain, hash из 32 байт). ValueError, если адрес некорректен.
+    """
+    address = address.strip()
+    if ':' in address:
+        workchain, _, account_hex = address.partition(':')
+        account = bytes.fromhex(account_hex)
+        if len(account) != 32:
+            raise ValueError(f"Неверная длина адреса: {address}")
+        return int(workchain), account
+    
+    if len(address) != 48:
+        raise ValueError(f"Неверная длина адреса: {address}")
+    data = base64.urlsafe_b64decode(address.replace('+', '-').replace('/', '_'))
+    if crc16(data[:34]) != int.from_bytes(data[34:], 'big'):
+        raise ValueError(f"Неверная контрольная сумма адреса: {address}")
+    if data[0] & 0x7F not in (0x11, 0x51):
+        raise ValueError(f"Неизвестный тип адреса: {address}")
+    return int.from_bytes(data[1:2], 'big', signed=True), data[2:34]
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def normalize_address(address):
+    """Канонический raw адрес (0:HEX, как в ответах toncenter) для любой формы адреса"""
+    workchain, account = parse_address(address)
+    return f"{workchain}:{account.hex().upper()}"
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def to_user_friendly(address, bounceable=False, testnet=False):
+    """User-friendly base64url форма адреса (по умолчанию UQ - для кошельков)"""
+    workchain, account = parse_address(address)
+    tag = 0x11 if bounceable else 0x51
+    if testnet:
+        tag |= 0x80
+    data = bytes([tag]) + workchain.to_bytes(1, 'big', signed=True) + account
+    return base64.urlsafe_b64encode(data + crc16(data).to_bytes(2, 'big')).decode()
+
+
+def format_amount(amount, decimals=9, symbol='TON'):
+    """Точная сумма из минимальных единиц (наноТОН или единицы jetton), без потери точности"""
+    try:
+        amount = int(amount)
+    except (TypeError, ValueError):
+        return f"{amount} наноТОН"
+    if not decimals:
+        return f"{amount} {symbol}"
+    whole, fraction = divmod(abs(amount), 10 ** decimals)
+    sign = '-' if amount < 0 else ''
+    if fraction:
+        return f"{sign}{whole}.{fraction:0{decimals}d}".rstrip('0') + f" {symbol}"
+    return f"{sign}{whole} {symbol}"
+
+
+@lru_cache(maxsize=TIME_FORMAT_CACHE_SIZE)
+def format_time(timestamp):
+    """Время транзакции в DISPLAY_TIMEZONE (по умолчанию - пояс сервера)"""
+    if DISPLAY_TIMEZONE is not None:
+        moment = datetime.fromtimestamp(timestamp, tz=DISPLAY_TIMEZONE)
+    else:
+        moment = datetime.fromtimestamp(timestamp).astimezone()
+    return moment.strftime(TIME_FORMAT)
+
+
+def telegram_length(text):
+    """Длина текста так, как ее считает Telegram (в единицах UTF-16)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def render_address_link(address, info):
+    """Markdown ссылка на адрес в TonViewer: домен, тип адреса и сокращенная форма"""
+    if not address:
+        return "Неизвестно"
+    user_friendly = info.get('user_friendly') or address
+    
+    # Тип адреса по префиксу
+    if user_friendly.startswith(('EQ', 'UQ')):
+        addr_type = user_friendly[:2]
+    elif user_friendly.startswith('0:'):
+        addr_type = "RAW"
+    else:
+        addr_type = "UNK"
+    
+    # Первые 6 и последние 4 символа
+    if len(user_friendly) > 10:
+        short_addr = user_friendly[:6] + "..." + user_friendly[-4:]
+    else:
+        short_addr = user_friendly
+    
+    domain = info.get('domain')
+    text = f"{domain} ({addr_type}:{short_addr})" if domain else f"{addr_type}:{short_addr}"
+    return ADDRESS_LINK_TEMPLATE(text=text, address=user_friendly)
+
+
+def extract_comment(message_data):
+    """Извлечение комментария из сообщения (входящего или исходящего)"""
+    try:
+        if not message_data:
+            return ""
+        
+        message_content = message_data.get('message_content') or {}
+        decoded = message_content.get('decoded') or {}
+        
+        if decoded.get('type') == 'text_comment':
+            return decoded.get('comment', '')
+        
+        return ""
+    except Exception as e:
+        logger.error(f"Ошибка извлечения комментария: {e}")
+        return ""
+
+
+class Cell:
+    """Ячейка TVM: биты данных (целое число и длина) и ссылки на дочерние ячейки"""
+    __slots__ = ('value', 'bits', 'refs')
     
-    def load_last_transactions(self):
-        """Загрузка последних транзакций из файла"""
+    def __init__(self, value, bits, refs):
+        self.value = value
+        self.bits = bits
+        self.refs = refs
+
+
+def parse_boc(data):
+    """Корневая ячейка из сериализованного BOC (тела сообщений из toncenter)
+    
+    ValueError, если данные не являются BOC или обрываются.
+    """
+    if len(data) < 6 or int.from_bytes(data[:4], 'big') != 0xb5ee9c72:
+        raise ValueError("Не BOC")
+    flags = data[4]
+    size = flags & 0x07
+    offset_size = data[5]
+    pos = 6
+    
+    def read(length):
+        nonlocal pos
+        if pos + length > len(data):
+            raise ValueError("BOC обрывается")
+        value = int.from_bytes(data[pos:pos + length], 'big')
+        pos += length
+        return value
+    
+    cells_count = read(size)
+    roots_count = read(size)
+    read(size)  # absent
+    read(offset_size)  # tot_cells_size
+    roots = [read(size) for _ in range(roots_count)]
+    if flags & 0x80:
+        pos += cells_count * offset_size  # индекс ячеек
+    
+    raw_cells = []
+    for _ in range(cells_count):
+        d1, d2 = read(1), read(1)
+        if d1 & 0x10:
+            pos += ((d1 >> 5) + 1) * 34  # сохраненные хэши и глубины
+        length = (d2 + 1) // 2
+        value = read(length) if length else 0
+        bits = length * 8
+        if d2 & 1:
+            # Неполный последний байт: данные завершаются битом 1 и нулями
+            if not value:
+                raise ValueError("Неверное завершение данных ячейки")
+            padding = (value & -value).bit_length()
+            value >>= padding
+            bits -= padding
+        raw_cells.append((value, bits, [read(size) for _ in range(d1 & 0x07)]))
+    
+    # Ссылки указывают только на следующие ячейки - собираем с конца
+    cells = [None] * cells_count
+    for index in range(cells_count - 1, -1, -1):
+        value, bits, refs = raw_cells[index]
+        if any(ref <= index or ref >= cells_count for ref in refs):
+            raise ValueError("Неверная ссылка в BOC")
+        cells[index] = Cell(value, bits, [cells[ref] for ref in refs])
+    if not roots or roots[0] >= cells_count:
+        raise ValueError("Нет корневой ячейки")
+    return cells[roots[0]]
+
+
+class Slice:
+    """Последовательное чтение полей из ячейки (схемы TL-B сообщений jetton и NFT)"""
+    __slots__ = ('cell', 'pos', 'ref')
+    
+    def __init__(self, cell):
+        self.cell = cell
+        self.pos = 0
+        self.ref = 0
+    
+    def remaining(self):
+        return self.cell.bits - self.pos
+    
+    def load_uint(self, bits):
+        if bits > self.remaining():
+            raise ValueError("Недостаточно данных в ячейке")
+        self.pos += bits
+        return (self.cell.value >> (self.cell.bits - self.pos)) & ((1 << bits) - 1)
+    
+    def load_coins(self):
+        return self.load_uint(self.load_uint(4) * 8)
+    
+    def load_ref(self):
+        if self.ref >= len(self.cell.refs):
+            raise ValueError("Нет ссылки в ячейке")
+        self.ref += 1
+        return Slice(self.cell.refs[self.ref - 1])
+    
+    def load_maybe_ref(self):
+        return self.load_ref() if self.load_uint(1) else None
+    
+    def load_address(self):
+        """MsgAddress: raw адрес (0:HEX) для addr_std, пустая строка для addr_none и внешних"""
+        tag = self.load_uint(2)
+        if tag == 0:
+            return ""
+        if tag == 1:
+            self.load_uint(self.load_uint(9))
+            return ""
+        if tag == 3:
+            raise ValueError("addr_var не поддерживается")
+        if self.load_uint(1):
+            self.load_uint(self.load_uint(5))  # anycast
+        workchain = self.load_uint(8)
+        if workchain > 127:
+            workchain -= 256
+        return f"{workchain}:{self.load_uint(256):064X}"
+    
+    def load_forward_payload(self):
+        """forward_payload (Either Cell ^Cell); None, если его нет"""
+        if not self.remaining():
+            return None
+        return self.load_ref() if self.load_uint(1) else self
+    
+    def load_text(self):
+        """Строка в snake-формате: данные ячейки и продолжение по первой ссылке"""
+        chunks = []
+        part = self
+        while True:
+            length = part.remaining() // 8
+            chunks.append(part.load_uint(length * 8).to_bytes(length, 'big'))
+            if part.ref >= len(part.cell.refs):
+                break
+            part = part.load_ref()
+        return b"".join(chunks).decode('utf-8', errors='replace')
+
+
+def payload_comment(payload):
+    """Текстовый комментарий из forward_payload (opcode 0 и текст)"""
+    if payload is None or payload.remaining() < 32 or payload.load_uint(32) != 0:
+        return ""
+    return payload.load_text()
+
+
+# opcode -> обработчик(транзакция, тело сообщения после opcode)
+OPCODE_HANDLERS = {}
+
+
+def opcode_handler(opcode):
+    """Регистрация обработчика тела сообщения с данным opcode"""
+    def register(handler):
+        OPCODE_HANDLERS[opcode] = handler
+        return handler
+    return register
+
+
+@opcode_handler(OP_JETTON_NOTIFY)
+def decode_jetton_notify(tx, body):
+    """transfer_notification: jetton кошелек владельца сообщает о полученных токенах"""
+    body.load_uint(64)  # query_id
+    amount = body.load_coins()
+    sender = body.load_address()
+    comment = payload_comment(body.load_forward_payload())
+    tx.kind, tx.asset, tx.asset_amount = 'jetton', tx.source, amount
+    tx.source = sender
+    tx.comment = comment or tx.comment
+
+
+@opcode_handler(OP_JETTON_TRANSFER)
+def decode_jetton_transfer(tx, body):
+    """transfer: владелец отправляет токены через свой jetton кошелек"""
+    body.load_uint(64)  # query_id
+    amount = body.load_coins()
+    destination = body.load_address()
+    body.load_address()  # response_destination
+    body.load_maybe_ref()  # custom_payload
+    body.load_coins()  # forward_ton_amount
+    comment = payload_comment(body.load_forward_payload())
+    tx.kind, tx.asset, tx.asset_amount = 'jetton', tx.destination, amount
+    tx.destination = destination
+    tx.comment = comment or tx.comment
+
+
+@opcode_handler(OP_JETTON_BURN)
+def decode_jetton_burn(tx, body):
+    """burn: владелец сжигает токены своего jetton кошелька"""
+    body.load_uint(64)  # query_id
+    amount = body.load_coins()
+    tx.kind, tx.asset, tx.asset_amount = 'jetton_burn', tx.destination, amount
+
+
+@opcode_handler(OP_NFT_TRANSFER)
+def decode_nft_transfer(tx, body):
+    """transfer: владелец передает NFT новому владельцу"""
+    body.load_uint(64)  # query_id
+    new_owner = body.load_address()
+    tx.kind, tx.asset = 'nft', tx.destination
+    tx.destination = new_owner
+
+
+@opcode_handler(OP_NFT_OWNERSHIP_ASSIGNED)
+def decode_nft_ownership_assigned(tx, body):
+    """ownership_assigned: NFT сообщает новому владельцу о передаче"""
+    body.load_uint(64)  # query_id
+    previous_owner = body.load_address()
+    comment = payload_comment(body.load_forward_payload())
+    tx.kind, tx.asset = 'nft', tx.source
+    tx.source = previous_owner
+    tx.comment = comment or tx.comment
+
+
+def decode_message(tx, message):
+    """Декодирование тела сообщения транзакции обработчиком, зарегистрированным для его opcode"""
+    # toncenter отдает opcode отдельно - тела прочих сообщений не разбираем
+    opcode = message.get('opcode')
+    if opcode is not None:
+        opcode = (int(opcode, 16) if isinstance(opcode, str) else int(opcode)) & 0xFFFFFFFF
+        if opcode not in OPCODE_HANDLERS:
+            return
+    
+    body = (message.get('message_content') or {}).get('body')
+    if not body:
+        return
+    body = Slice(parse_boc(base64.b64decode(body)))
+    if body.remaining() < 32:
+        return
+    handler = OPCODE_HANDLERS.get(body.load_uint(32))
+    if handler is not None:
+        handler(tx, body)
+
+
+@dataclass(slots=True)
+class Transaction:
+    """Компактная запись транзакции: только поля, нужные для уведомлений и курсоров
+    
+    direction: 'in' - входящая, 'out' - исходящая, 'other' - прочие.
+    amount - сумма в наноТОН, адреса в raw форме как в ответе API.
+    kind - 'jetton', 'jetton_burn' или 'nft' для декодированных переводов (пусто для TON):
+    asset - jetton кошелек или NFT, asset_amount - сумма в единицах jetton,
+    source/destination - реальные отправитель и получатель токенов.
+    """
+    hash: str
+    lt: int
+    now: int
+    account: str
+    direction: str
+    amount: int
+    source: str
+    destination: str
+    comment: str
+    kind: str = ''
+    asset: str = ''
+    asset_amount: int = 0
+    
+    @classmethod
+    def from_api(cls, tx):
+        """Нормализация транзакции из ответа toncenter API v3"""
+        in_msg = tx.get('in_msg') or {}
+        out_msgs = tx.get('out_msgs') or []
+        
+        if in_msg.get('source') and in_msg.get('destination'):
+            direction = 'in'
+            message = in_msg
+            source = in_msg['source']
+            destination = in_msg['destination']
+        elif out_msgs:
+            direction = 'out'
+            message = out_msgs[0]
+            source = tx.get('account', '')
+            destination = message.get('destination') or ''
+        else:
+            direction = 'other'
+            message = None
+            source = destination = ''
+        
         try:
-            with open(LAST_TX_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except FileNotFoundError:
+            amount = int(message.get('value') or 0) if message else 0
+        except (TypeError, ValueError):
+            amount = 0
+        
+        transaction = cls(
+            hash=tx.get('hash', ''),
+            lt=int(tx.get('lt') or 0),
+            now=int(tx.get('now') or 0),
+            account=tx.get('account', ''),
+            direction=direction,
+            amount=amount,
+            source=source,
+            destination=destination,
+            comment=extract_comment(message)
+        )
+        
+        if message:
+            try:
+                decode_message(transaction, message)
+            except Exception as e:
+                # Нестандартное тело: транзакция остается обычным переводом TON
+                logger.debug(f"Не удалось декодировать сообщение {transaction.hash}: {e}")
+        return transaction
+    
+    def to_row(self):
+        """Компактное представление для хранения (список полей)"""
+        row = [self.hash, self.lt, self.now, self.account, self.direction,
+               self.amount, self.source, self.destination, self.comment]
+        if self.kind:
+            row += [self.kind, self.asset, self.asset_amount]
+        return row
+    
+    @classmethod
+    def from_stored(cls, data):
+        """Загрузка из хранилища: компактная запись или сырой JSON старого формата"""
+        if isinstance(data, list):
+            return cls(*data)
+        return cls.from_api(data)
+
+
+def transaction_label(tx):
+    """Подпись типа транзакции: вид декодированного перевода или направление"""
+    return TX_KIND_LABELS.get((tx.kind, tx.direction)) or TX_TYPE_LABELS[tx.direction]
+
+
+def counterparty(tx):
+    """Контрагент транзакции: отправитель входящей, получатель исходящей"""
+    return tx.source if tx.direction == 'in' else tx.destination
+
+
+def compile_filter(rules):
+    """Предикат транзакции из правил фильтра подписки; None, если правил нет
+    
+    Проверяются только заданные правила: min_amount (наноТОН, переводы токенов
+    не ограничивает), direction, allow/deny (контрагенты) и keywords (подстроки
+    комментария без учета регистра: проверка линейна по длине комментария).
+    """
+    checks = []
+    direction = rules.get('direction')
+    if direction:
+        checks.append(lambda tx: tx.direction == direction)
+    min_amount = rules.get('min_amount')
+    if min_amount:
+        checks.append(lambda tx: bool(tx.kind) or tx.amount >= min_amount)
+    allow = frozenset(rules.get('allow') or ())
+    if allow:
+        checks.append(lambda tx: counterparty(tx) in allow)
+    deny = frozenset(rules.get('deny') or ())
+    if deny:
+        checks.append(lambda tx: counterparty(tx) not in deny)
+    keywords = tuple(rules.get('keywords') or ())
+    if keywords:
+        def has_keyword(tx):
+            comment = tx.comment[:FILTER_COMMENT_SCAN_LENGTH].casefold()
+            return any(keyword in comment for keyword in keywords)
+        checks.append(has_keyword)
+    
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+    return lambda tx: all(check(tx) for check in checks)
+
+
+def parse_ton_amount(text):
+    """Сумма в TON (до 9 знаков после точки или запятой) в наноТОН без потери точности"""
+    whole, _, fraction = text.replace(',', '.').partition('.')
+    if not (whole or fraction) or not (whole or '0').isdigit() or (fraction and not fraction.isdigit()) \
+            or len(fraction) > 9:
+        raise ValueError(f"Неверная сумма: {text}")
+    return int(whole or 0) * NANOTON + int(fraction.ljust(9, '0'))
+
+
+def parse_filter_rules(args):
+    """Правила фильтра из аргументов /filter: min=1.5 dir=in allow=<адреса> deny=<адреса> comment=<слова>
+    
+    comment - последнее правило: в него входит остаток строки, ключевые слова через запятую.
+    ValueError с описанием ошибки.
+    """
+    rules = {}
+    for i, arg in enumerate(args):
+        name, sep, value = arg.partition('=')
+        if not sep or not value:
+            raise ValueError(f"Неверное правило: {arg}")
+        if name == 'comment':
+            keywords = {
+                keyword.strip().casefold() for keyword in ' '.join([value, *args[i + 1:]]).split(',')
+            }
+            keywords.discard('')
+            if not keywords:
+                raise ValueError("Укажите ключевые слова комментария")
+            if len(keywords) > FILTER_MAX_KEYWORDS:
+                raise ValueError(f"Не больше {FILTER_MAX_KEYWORDS} ключевых слов")
+            if any(len(keyword) > FILTER_KEYWORD_MAX_LENGTH for keyword in keywords):
+                raise ValueError(f"Ключевое слово длиннее {FILTER_KEYWORD_MAX_LENGTH} символов")
+            rules['keywords'] = sorted(keywords)
+            break
+        if name == 'min':
+            rules['min_amount'] = parse_ton_amount(value)
+        elif name == 'dir':
+            if value not in FILTER_DIRECTIONS:
+                raise ValueError("Направление: dir=in или dir=out")
+            rules['direction'] = value
+        elif name in ('allow', 'deny'):
+            # Адреса хранятся в raw форме, как контрагенты транзакций
+            try:
+                rules[name] = sorted({normalize_address(address) for address in value.split(',') if address})
+            except ValueError:
+                raise ValueError(f"Неверный адрес в {name}")
+        else:
+            raise ValueError(f"Неизвестное правило: {name}")
+    return rules
+
+
+def describe_filter(rules):
+    """Описание правил фильтра для ответа в чат"""
+    if not rules:
+        return "без фильтра - все транзакции"
+    lines = []
+    if rules.get('min_amount'):
+        lines.append(f"• от {format_amount(rules['min_amount'])}")
+    if rules.get('direction'):
+        lines.append(f"• {FILTER_DIRECTIONS[rules['direction']]}")
+    for name, title in (('allow', "только с адресами"), ('deny', "кроме адресов")):
+        if rules.get(name):
+            addresses = ', '.join(f"`{to_user_friendly(address)}`" for address in rules[name])
+            lines.append(f"• {title}: {addresses}")
+    if rules.get('keywords'):
+        keywords = ', '.join(f"`{keyword.replace('`', '')}`" for keyword in rules['keywords'])
+        lines.append(f"• комментарий содержит: {keywords}")
+    return "\n".join(lines)
+
+
+def parse_transactions(raw_transactions):
+    """Нормализация списка транзакций из ответа API"""
+    return [Transaction.from_api(tx) for tx in raw_transactions]
+
+
+class AddressBookCache:
+    """Кэш address_book (user-friendly форма и .ton домен) с TTL и вытеснением LRU
+    
+    Пополняется из ответов API, хранится между перезапусками в хранилище.
+    В хранилище записываются только новые и изменившиеся записи.
+    """
+    def __init__(self, storage, ttl=ADDRESS_BOOK_TTL, max_size=ADDRESS_BOOK_MAX_SIZE):
+        self.storage = storage
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # raw адрес -> (данные, время истечения)
+        self.links = {}  # raw адрес -> готовая Markdown ссылка (пока запись не изменилась)
+        for address, (info, expires_at) in storage.load_address_book().items():
+            self.entries[address] = (info, expires_at)
+        self.evict()
+    
+    def __contains__(self, address):
+        entry = self.entries.get(address)
+        return entry is not None and entry[1] > time.time()
+    
+    def get(self, address):
+        """Данные адреса или пустой словарь, если адрес неизвестен или устарел"""
+        entry = self.entries.get(address)
+        if entry is None or entry[1] <= time.time():
             return {}
+        self.entries.move_to_end(address)
+        return entry[0]
+    
+    def update(self, address_book):
+        """Добавление записей из ответа API"""
+        now = time.time()
+        changed = {}
+        for address, info in address_book.items():
+            info = {'user_friendly': info.get('user_friendly'), 'domain': info.get('domain')}
+            entry = self.entries.get(address)
+            # Свежие неизменившиеся записи не перезаписываем
+            if entry is not None and entry[0] == info and entry[1] - now > self.ttl / 2:
+                self.entries.move_to_end(address)
+                continue
+            self.entries[address] = (info, now + self.ttl)
+            self.entries.move_to_end(address)
+            self.links.pop(address, None)
+            changed[address] = self.entries[address]
+        
+        if changed:
+            self.evict()
+            self.storage.save_address_book(changed)
+    
+    def evict(self):
+        while len(self.entries) > self.max_size:
+            address, _ = self.entries.popitem(last=False)
+            self.links.pop(address, None)
+    
+    def link(self, address):
+        """Markdown ссылка на адрес; для известных адресов строится один раз"""
+        link = self.links.get(address)
+        if link is not None:
+            if address in self:
+                self.entries.move_to_end(address)
+                return link
+            # Запись устарела: ссылка строится заново, как для неизвестного адреса
+            del self.links[address]
+        info = self.get(address)
+        link = render_address_link(address, info)
+        if info:
+            self.links[address] = link
+        return link
+    
+    def missing(self, addresses):
+        """Адреса, которых нет в кэше"""
+        return [address for address in addresses if address and address not in self]
+
+
+class JettonCache:
+    """Метаданные jetton (symbol, decimals) по мастер-контракту и мастер по jetton кошельку
+    
+    Оба соответствия неизменны, поэтому хранятся без TTL; при переполнении
+    вытесняются давно неиспользуемые записи. Каждый jetton кошелек и мастер
+    запрашиваются у API один раз, пока запись в кэше.
+    """
+    def __init__(self, max_size=JETTON_CACHE_SIZE):
+        self.max_size = max_size
+        self.wallets = OrderedDict()  # jetton кошелек -> (мастер, владелец) или None, если это не jetton кошелек
+        self.masters = OrderedDict()  # мастер -> {'symbol': ..., 'decimals': ...}
+    
+    def put(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
     
-    def load_chat_settings(self):
-        """Загрузка настроек чатов"""
+    def token(self, tx):
+        """Метаданные токена перевода или None, если jetton кошелек не подтвержден
+        
+        Кошелек подтвержден, если API знает его как jetton кошелек отслеживаемого адреса:
+        так поддельные transfer_notification от произвольных контрактов не выдаются за токены.
+        """
+        entry = self.wallets.get(tx.asset)
+        if not entry or entry[1] != tx.account:
+            return None
+        self.wallets.move_to_end(tx.asset)
+        metadata = self.masters.get(entry[0])
+        if metadata is not None:
+            self.masters.move_to_end(entry[0])
+        return metadata
+    
+    async def resolve(self, monitor, client, transactions):
+        """Дозапрос неизвестных jetton кошельков и мастеров для переводов транзакций"""
+        wallets = {
+            tx.asset for tx in transactions
+            if tx.kind in ('jetton', 'jetton_burn') and tx.asset and tx.asset not in self.wallets
+        }
+        for chunk in batched(sorted(wallets), ADDRESS_BOOK_BATCH):
+            data = await monitor.api_get(client, JETTON_WALLETS_PATH, {'address': chunk, 'limit': len(chunk)})
+            if data is None:
+                continue  # Повторим при следующем переводе
+            found = {}
+            for item in data.get('jetton_wallets', []):
+                try:
+                    found[normalize_address(item['address'])] = (
+                        normalize_address(item['jetton']), normalize_address(item['owner'])
+                    )
+                except (KeyError, ValueError):
+                    continue
+            for wallet in chunk:
+                self.put(self.wallets, wallet, found.get(wallet))
+        
+        masters = {
+            entry[0] for entry in map(self.wallets.get, wallets) if entry and entry[0] not in self.masters
+        }
+        for chunk in batched(sorted(masters), ADDRESS_BOOK_BATCH):
+            data = await monitor.api_get(client, JETTON_MASTERS_PATH, {'address': chunk, 'limit': len(chunk)})
+            if data is None:
+                continue
+            metadata = data.get('metadata') or {}
+            for item in data.get('jetton_masters', []):
+                try:
+                    master = normalize_address(item['address'])
+                except (KeyError, ValueError):
+                    continue
+                self.put(self.masters, master, jetton_metadata(item, metadata.get(item['address'])))
+
+
+def jetton_metadata(master, metadata):
+    """symbol и decimals мастера: из jetton_content или (для offchain) из metadata ответа API"""
+    content = master.get('jetton_content') or {}
+    token_info = ((metadata or {}).get('token_info') or [{}])[0]
+    symbol = content.get('symbol') or token_info.get('symbol') or "?"
+    decimals = content.get('decimals') or (token_info.get('extra') or {}).get('decimals') or 9
+    try:
+        decimals = int(decimals)
+    except (TypeError, ValueError):
+        decimals = 9
+    return {'symbol': str(symbol).translate(MARKDOWN_ESCAPE), 'decimals': decimals}
+
+
+def digest_windows(chat_settings):
+    """Окна сводки (секунды) чатов, включивших режим сводки"""
+    return {
+        chat_id: settings['digest_window'] for chat_id, settings in chat_settings.items()
+        if settings.get('digest_window')
+    }
+
+
+def batched(items, size):
+    """Разбиение списка на части не длиннее size"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class DigestBuffer:
+    """События чатов в режиме сводки, накопленные с начала текущего окна"""
+    def __init__(self):
+        # chat_id -> (начало окна, {кошелек: [(транзакция, строка сводки)] от новых к старым})
+        self.entries = {}
+        self.sizes = {}  # chat_id -> число накопленных транзакций
+    
+    def add(self, chat_id, wallet, events):
+        """Добавление событий кошелька [(транзакция, строка)]; число накопленных транзакций чата"""
+        entry = self.entries.get(chat_id)
+        if entry is None:
+            entry = self.entries[chat_id] = (time.monotonic(), {})
+        wallets = entry[1]
+        wallets[wallet] = events + wallets.get(wallet, [])
+        self.sizes[chat_id] = self.sizes.get(chat_id, 0) + len(events)
+        return self.sizes[chat_id]
+    
+    def due(self, windows):
+        """Чаты, окно которых истекло (или режим сводки выключен)"""
+        now = time.monotonic()
+        return [
+            chat_id for chat_id, (started, _) in self.entries.items()
+            if chat_id not in windows or now - started >= windows[chat_id]
+        ]
+    
+    def pop(self, chat_id):
+        """Накопленные события чата: (длительность окна в секундах, {кошелек: события}) или None"""
+        self.sizes.pop(chat_id, None)
+        entry = self.entries.pop(chat_id, None)
+        if entry is None:
+            return None
+        return time.monotonic() - entry[0], entry[1]
+
+
+class ActivityView:
+    """Последняя активность кошельков по чатам для /lasttransactions
+    
+    Порядок кошельков чата (от самых свежих) строится при первом запросе и затем
+    обновляется инкрементально; текст кошелька и его длина кэшируются до его новых
+    транзакций, границы страниц чата - до изменения его порядка или фрагментов.
+    """
+    def __init__(self):
+        self.order = {}  # chat_id -> OrderedDict[кошелек, None], в конце - самые свежие
+        self.fragments = {}  # кошелек -> (готовый фрагмент текста, его длина в Telegram)
+        self.pages = {}  # chat_id -> кошельки каждой страницы
+    
+    def touch(self, wallet, chats):
+        """Новые транзакции кошелька: сбросить его фрагмент и поднять кошелек в чатах"""
+        self.fragments.pop(wallet, None)
+        for chat_id in chats:
+            order = self.order.get(chat_id)
+            if order is not None:
+                order[wallet] = None
+                order.move_to_end(wallet)
+            self.pages.pop(chat_id, None)
+    
+    def invalidate_chat(self, chat_id):
+        """Изменились подписки чата: порядок и страницы будут построены заново"""
+        self.order.pop(str(chat_id), None)
+        self.pages.pop(str(chat_id), None)
+    
+    def forget(self, wallet):
+        """Кошелек удален или его история пуста: убрать его фрагмент и из порядка чатов"""
+        self.fragments.pop(wallet, None)
+        for chat_id, order in self.order.items():
+            if wallet in order:
+                del order[wallet]
+                self.pages.pop(chat_id, None)
+    
+    def chat_order(self, chat_id, wallets, last_transactions):
+        order = self.order.get(chat_id)
+        if order is None:
+            active = sorted(
+                (wallet for wallet in wallets if last_transactions.get(wallet)),
+                key=lambda wallet: last_transactions[wallet][0].lt
+            )
+            order = self.order[chat_id] = OrderedDict.fromkeys(active)
+        return order
+    
+    def fragment(self, wallet, render):
+        """Фрагмент кошелька и его длина (рендерится только после сброса)"""
+        cached = self.fragments.get(wallet)
+        if cached is None:
+            fragment = render(wallet)
+            cached = self.fragments[wallet] = (fragment, telegram_length(fragment))
+        return cached
+    
+    def paginate(self, order, render, page_size, max_length):
+        """Разбиение кошельков чата на страницы по кэшированным длинам фрагментов
+        
+        Страница заканчивается на page_size кошельках или раньше, если следующий
+        фрагмент не помещается в max_length; он открывает следующую страницу.
+        """
+        pages = []
+        current = []
+        length = 0
+        for wallet in reversed(order):
+            fragment_length = self.fragment(wallet, render)[1]
+            if current and (len(current) == page_size or length + fragment_length > max_length):
+                pages.append(current)
+                current = []
+                length = 0
+            current.append(wallet)
+            length += fragment_length
+        if current:
+            pages.append(current)
+        return pages
+    
+    def page(self, chat_id, wallets, last_transactions, render, page, page_size, max_length):
+        """Фрагменты страницы page (с 0): (фрагменты, номер страницы, число страниц)"""
+        pages = self.pages.get(chat_id)
+        if pages is None:
+            order = self.chat_order(chat_id, wallets, last_transactions)
+            pages = self.pages[chat_id] = self.paginate(order, render, page_size, max_length)
+        if not pages:
+            return [], 0, 1
+        page = min(max(page, 0), len(pages) - 1)
+        return [self.fragment(wallet, render)[0] for wallet in pages[page]], page, len(pages)
+
+
+class JsonStorage:
+    """Хранение данных в JSON файлах с отложенной записью
+    
+    Изменения только помечают файл как измененный. Снимки измененных файлов
+    записываются не чаще раза в PERSIST_INTERVAL секунд (flush) и при закрытии,
+    атомарно: через временный файл и os.replace.
+    """
+    def __init__(self):
+        self.wallets = {}
+        self.last_transactions = {}
+        self.chat_settings = {}
+        self.cursors = {}
+        self.address_book = {}
+        self.dirty = set()  # Файлы с незаписанными изменениями
+        self.snapshots = {
+            WALLETS_FILE: lambda: {wallet: list(chats.values()) for wallet, chats in self.wallets.items()},
+            LAST_TX_FILE: lambda: {
+                wallet: [tx.to_row() for tx in transactions]
+                for wallet, transactions in self.last_transactions.items()
+            },
+            SETTINGS_FILE: lambda: self.chat_settings,
+            CURSORS_FILE: lambda: self.cursors,
+            ADDRESS_BOOK_FILE: lambda: self.address_book,
+        }
+    
+    def load_file(self, path):
+        """Загрузка словаря из JSON файла"""
         try:
-            with open(SETTINGS_FILE, 'r', encoding='utf-8') as f:
+            with open(path, 'r', encoding='utf-8') as f:
                 return json.load(f)
         except FileNotFoundError:
             return {}
     
-    def save_wallets(self):
-        """Сохранение списка кошельков в файл"""
-        with open(WALLETS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.wallets, f, ensure_ascii=False, indent=2)
+    def dump_file(self, path, data):
+        """Атомарное сохранение словаря в JSON файл: при сбое остается прежняя версия"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json_dumps(data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    
+    def flush(self):
+        """Запись снимков всех измененных файлов"""
+        if not self.dirty:
+            return
+        started = time.monotonic()
+        while self.dirty:
+            path = self.dirty.pop()
+            try:
+                self.dump_file(path, self.snapshots[path]())
+            except Exception:
+                self.dirty.add(path)
+                raise
+        metrics.observe('ton_monitor_storage_flush_seconds', time.monotonic() - started, (('backend', 'json'),))
+    
+    def load(self):
+        """Загрузка всех данных: (кошельки, транзакции, настройки чатов, курсоры)
+        
+        Подписки возвращаются в виде {кошелек: {chat_id: данные подписки}},
+        в файле они хранятся списком.
+        """
+        self.wallets = {
+            wallet: {str(chat['chat_id']): chat for chat in chats}
+            for wallet, chats in self.load_file(WALLETS_FILE).items()
+        }
+        self.last_transactions = {
+            wallet: [Transaction.from_stored(tx) for tx in transactions]
+            for wallet, transactions in self.load_file(LAST_TX_FILE).items()
+        }
+        self.chat_settings = self.load_file(SETTINGS_FILE)
+        self.cursors = self.load_file(CURSORS_FILE)
+        return self.wallets, self.last_transactions, self.chat_settings, self.cursors
+    
+    def load_subscriptions(self):
+        """Повторная загрузка подписок и настроек чатов: (кошельки, настройки чатов)"""
+        wallets = {
+            wallet: {str(chat['chat_id']): chat for chat in chats}
+            for wallet, chats in self.load_file(WALLETS_FILE).items()
+        }
+        return wallets, self.load_file(SETTINGS_FILE)
+    
+    def load_wallet_state(self, wallets):
+        """Транзакции и курсоры указанных кошельков: (транзакции, курсоры)"""
+        stored = self.load_file(LAST_TX_FILE)
+        cursors = self.load_file(CURSORS_FILE)
+        return (
+            {wallet: [Transaction.from_stored(tx) for tx in stored[wallet]] for wallet in wallets if wallet in stored},
+            {wallet: cursors[wallet] for wallet in wallets if wallet in cursors}
+        )
+    
+    def save_subscription(self, wallet, chat_info):
+        self.dirty.add(WALLETS_FILE)
+    
+    def delete_subscription(self, wallet, chat_id):
+        self.dirty.add(WALLETS_FILE)
+    
+    def delete_wallet(self, wallet):
+        self.dirty.update((WALLETS_FILE, LAST_TX_FILE, CURSORS_FILE))
+    
+    def add_transactions(self, wallet, transactions):
+        self.dirty.add(LAST_TX_FILE)
+    
+    def save_chat_settings(self, chat_id, settings):
+        self.dirty.add(SETTINGS_FILE)
+    
+    def save_cursors(self, cursors):
+        self.dirty.add(CURSORS_FILE)
+    
+    def load_address_book(self):
+        """Загрузка кэша address_book: {адрес: (данные, время истечения)} без устаревших"""
+        now = time.time()
+        self.address_book = {
+            address: tuple(entry) for address, entry in self.load_file(ADDRESS_BOOK_FILE).items()
+            if entry[1] > now
+        }
+        return self.address_book
+    
+    def save_address_book(self, entries):
+        self.address_book.update(entries)
+        self.dirty.add(ADDRESS_BOOK_FILE)
+    
+    def close(self):
+        self.flush()
+
+
+class SqliteStorage:
+    """Хранение данных в SQLite (WAL): изменения записываются построчно в транзакциях"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            wallet TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            chat_type TEXT,
+            added_at TEXT,
+            filters TEXT,
+            PRIMARY KEY (wallet, chat_id)
+        );
+        CREATE INDEX IF NOT EXISTS subscriptions_chat_id ON subscriptions (chat_id);
+        CREATE TABLE IF NOT EXISTS transactions (
+            wallet TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            lt INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (wallet, hash)
+        );
+        CREATE INDEX IF NOT EXISTS transactions_wallet_lt ON transactions (wallet, lt DESC);
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS cursors (
+            wallet TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS address_book (
+            address TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+    
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        # Блокировка: чтения для /lasttransactions бота шардированного режима идут через asyncio.to_thread
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # Базы, созданные до фильтров подписок
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(subscriptions)")}
+        if 'filters' not in columns:
+            self.conn.execute("ALTER TABLE subscriptions ADD COLUMN filters TEXT")
+    
+    def execute(self, statements):
+        """Выполнение нескольких запросов в одной транзакции"""
+        started = time.monotonic()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        metrics.observe('ton_monitor_storage_flush_seconds', time.monotonic() - started, (('backend', 'sqlite'),))
+    
+    def is_empty(self):
+        with self.lock:
+            return all(
+                self.conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None
+                for table in ('subscriptions', 'transactions', 'chat_settings', 'cursors')
+            )
+    
+    def load(self):
+        """Загрузка всех данных: (кошельки, транзакции, настройки чатов, курсоры)"""
+        if self.is_empty():
+            migrate_json_to_sqlite(self)
+        
+        wallets = {}
+        last_transactions = {}
+        with self.lock:
+            for wallet, chat_id, chat_type, added_at, rules in self.conn.execute(
+                    "SELECT wallet, chat_id, chat_type, added_at, filters FROM subscriptions ORDER BY rowid"):
+                chat_info = wallets.setdefault(wallet, {})[chat_id] = {
+                    'chat_id': chat_id,
+                    'chat_type': chat_type,
+                    'added_at': added_at
+                }
+                if rules:
+                    chat_info['filters'] = json.loads(rules)
+            for wallet, data in self.conn.execute(
+                    "SELECT wallet, data FROM transactions ORDER BY wallet, lt DESC"):
+                last_transactions.setdefault(wallet, []).append(Transaction.from_stored(json.loads(data)))
+            chat_settings = {
+                chat_id: json.loads(data)
+                for chat_id, data in self.conn.execute("SELECT chat_id, data FROM chat_settings")
+            }
+            cursors = {
+                wallet: json.loads(data)
+                for wallet, data in self.conn.execute("SELECT wallet, data FROM cursors")
+            }
+        return wallets, last_transactions, chat_settings, cursors
+    
+    def load_subscriptions(self):
+        """Повторная загрузка подписок и настроек чатов: (кошельки, настройки чатов)"""
+        wallets = {}
+        with self.lock:
+            for wallet, chat_id, chat_type, added_at, rules in self.conn.execute(
+                    "SELECT wallet, chat_id, chat_type, added_at, filters FROM subscriptions ORDER BY rowid"):
+                chat_info = wallets.setdefault(wallet, {})[chat_id] = {
+                    'chat_id': chat_id,
+                    'chat_type': chat_type,
+                    'added_at': added_at
+                }
+                if rules:
+                    chat_info['filters'] = json.loads(rules)
+            chat_settings = {
+                chat_id: json.loads(data)
+                for chat_id, data in self.conn.execute("SELECT chat_id, data FROM chat_settings")
+            }
+        return wallets, chat_settings
     
-    def save_last_transactions(self):
-        """Сохранение последних транзакций в файл"""
-        with open(LAST_TX_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.last_transactions, f, ensure_ascii=False, indent=2)
+    def load_wallet_state(self, wallets):
+        """Транзакции и курсоры указанных кошельков: (транзакции, курсоры)"""
+        last_transactions = {}
+        cursors = {}
+        wallets = list(wallets)
+        with self.lock:
+            for i in range(0, len(wallets), 500):
+                chunk = wallets[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for wallet, data in self.conn.execute(
+                        f"SELECT wallet, data FROM transactions WHERE wallet IN ({placeholders}) "
+                        "ORDER BY wallet, lt DESC", chunk):
+                    last_transactions.setdefault(wallet, []).append(Transaction.from_stored(json.loads(data)))
+                for wallet, data in self.conn.execute(
+                        f"SELECT wallet, data FROM cursors WHERE wallet IN ({placeholders})", chunk):
+                    cursors[wallet] = json.loads(data)
+        return last_transactions, cursors
     
-    def save_chat_settings(self):
-        """Сохранение настроек чатов"""
-        with open(SETTINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.chat_settings, f, ensure_ascii=False, indent=2)
+    def save_subscription(self, wallet, chat_info):
+        self.execute([(
+            "INSERT OR REPLACE INTO subscriptions (wallet, chat_id, chat_type, added_at, filters) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (wallet, chat_info['chat_id'], chat_info.get('chat_type'), chat_info.get('added_at'),
+             json.dumps(chat_info['filters'], ensure_ascii=False) if chat_info.get('filters') else None)
+        )])
+    
+    def delete_subscription(self, wallet, chat_id):
+        self.execute([(
+            "DELETE FROM subscriptions WHERE wallet = ? AND chat_id = ?", (wallet, str(chat_id))
+        )])
+    
+    def delete_wallet(self, wallet):
+        self.execute([
+            ("DELETE FROM subscriptions WHERE wallet = ?", (wallet,)),
+            ("DELETE FROM transactions WHERE wallet = ?", (wallet,)),
+            ("DELETE FROM cursors WHERE wallet = ?", (wallet,)),
+        ])
+    
+    def add_transactions(self, wallet, transactions):
+        """Добавление новых транзакций кошелька с удалением самых старых сверх лимита"""
+        statements = [(
+            "INSERT OR IGNORE INTO transactions (wallet, hash, lt, data) VALUES (?, ?, ?, ?)",
+            (wallet, tx.hash, tx.lt, json.dumps(tx.to_row(), ensure_ascii=False))
+        ) for tx in transactions]
+        statements.append((
+            "DELETE FROM transactions WHERE wallet = ? AND hash NOT IN "
+            "(SELECT hash FROM transactions WHERE wallet = ? ORDER BY lt DESC LIMIT ?)",
+            (wallet, wallet, MAX_STORED_TRANSACTIONS)
+        ))
+        self.execute(statements)
+    
+    def save_chat_settings(self, chat_id, settings):
+        self.execute([(
+            "INSERT OR REPLACE INTO chat_settings (chat_id, data) VALUES (?, ?)",
+            (str(chat_id), json.dumps(settings, ensure_ascii=False))
+        )])
+    
+    def save_cursors(self, cursors):
+        self.execute([(
+            "INSERT OR REPLACE INTO cursors (wallet, data) VALUES (?, ?)",
+            (wallet, json.dumps(cursor))
+        ) for wallet, cursor in cursors.items()])
+    
+    def load_address_book(self):
+        """Загрузка кэша address_book: {адрес: (данные, время истечения)} без устаревших"""
+        now = time.time()
+        self.execute([("DELETE FROM address_book WHERE expires_at <= ?", (now,))])
+        with self.lock:
+            # Сначала старые записи, чтобы при вытеснении LRU первыми уходили они
+            return {
+                address: (json.loads(data), expires_at)
+                for address, data, expires_at in self.conn.execute(
+                    "SELECT address, data, expires_at FROM address_book ORDER BY expires_at")
+            }
+    
+    def save_address_book(self, entries):
+        self.execute([(
+            "INSERT OR REPLACE INTO address_book (address, data, expires_at) VALUES (?, ?, ?)",
+            (address, json.dumps(info, ensure_ascii=False), expires_at)
+        ) for address, (info, expires_at) in entries.items()])
+    
+    def flush(self):
+        """Изменения уже записаны построчно"""
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def migrate_json_to_sqlite(storage):
+    """Однократный перенос данных из JSON файлов в пустую базу SQLite"""
+    if not any(os.path.exists(path) for path in (WALLETS_FILE, LAST_TX_FILE, SETTINGS_FILE, CURSORS_FILE)):
+        return
+    
+    wallets, last_transactions, chat_settings, cursors = JsonStorage().load()
+    statements = []
+    for wallet, chats in wallets.items():
+        for chat_info in chats.values():
+            statements.append((
+                "INSERT OR REPLACE INTO subscriptions (wallet, chat_id, chat_type, added_at, filters) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (wallet, str(chat_info['chat_id']), chat_info.get('chat_type'), chat_info.get('added_at'),
+                 json.dumps(chat_info['filters'], ensure_ascii=False) if chat_info.get('filters') else None)
+            ))
+    for wallet, transactions in last_transactions.items():
+        for tx in transactions[:MAX_STORED_TRANSACTIONS]:
+            statements.append((
+                "INSERT OR IGNORE INTO transactions (wallet, hash, lt, data) VALUES (?, ?, ?, ?)",
+                (wallet, tx.hash, tx.lt, json.dumps(tx.to_row(), ensure_ascii=False))
+            ))
+    for chat_id, settings in chat_settings.items():
+        statements.append((
+            "INSERT OR REPLACE INTO chat_settings (chat_id, data) VALUES (?, ?)",
+            (chat_id, json.dumps(settings, ensure_ascii=False))
+        ))
+    for wallet, cursor in cursors.items():
+        statements.append((
+            "INSERT OR REPLACE INTO cursors (wallet, data) VALUES (?, ?)",
+            (wallet, json.dumps(cursor))
+        ))
+    
+    storage.execute(statements)
+    logger.info(f"Данные перенесены из JSON в {storage.path}: {len(wallets)} кошельков, {len(chat_settings)} чатов")
+
+
+def create_storage():
+    """Создание хранилища согласно STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteStorage()
+    return JsonStorage()
+
+
+class HashRing:
+    """Консистентное хеширование кошельков по воркерам
+    
+    Каждый воркер занимает HASH_RING_REPLICAS точек на кольце, поэтому при
+    появлении или выбывании воркера переезжает только ~1/N кошельков.
+    """
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        self.ring = sorted(
+            (self.hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)
+        )
+        self.points = [point for point, _ in self.ring]
+    
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+    
+    def node_for(self, key):
+        """Воркер, отвечающий за ключ (None, если воркеров нет)"""
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.points, self.hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class SqliteBroker:
+    """Брокер шардированного режима на SQLite: реестр воркеров и очередь уведомлений
+    
+    Подходит для процессов на одном хосте; для нескольких хостов его место
+    занимает сетевой брокер с тем же набором методов.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS workers (
+            worker_id TEXT PRIMARY KEY,
+            heartbeat REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            wallet TEXT NOT NULL,
+            message TEXT NOT NULL,
+            chats TEXT,
+            events TEXT,
+            created REAL NOT NULL,
+            delivered INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS notifications_pending ON notifications (delivered, id);
+    """
+    
+    def __init__(self, path=BROKER_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        # Базу одновременно используют несколько процессов: ждем снятия блокировки
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(notifications)")}
+        for column in ('chats', 'events'):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE notifications ADD COLUMN {column} TEXT")
+    
+    def heartbeat(self, worker_id):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO workers (worker_id, heartbeat) VALUES (?, ?)", (worker_id, time.time())
+            )
+    
+    def leave(self, worker_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+    
+    def live_workers(self):
+        """Воркеры, отметившиеся за последние WORKER_TIMEOUT секунд"""
+        with self.lock:
+            return sorted(
+                worker_id for (worker_id,) in self.conn.execute(
+                    "SELECT worker_id FROM workers WHERE heartbeat > ?", (time.time() - WORKER_TIMEOUT,))
+            )
+    
+    def publish(self, wallet, key, message, chats=None, events=None):
+        """Уведомление в очередь; повтор с тем же ключом (например, при переезде кошелька) отбрасывается
+        
+        chats - чаты, прошедшие фильтры подписок; None - все подписчики кошелька.
+        events - транзакции уведомления со строками сводки для чатов в режиме сводки.
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO notifications (key, wallet, message, chats, events, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, wallet, message, json.dumps(chats) if chats is not None else None,
+                 json.dumps(events, ensure_ascii=False) if events is not None else None, time.time())
+            )
+    
+    def consume(self, limit=BROKER_BATCH):
+        """Забрать до limit недоставленных уведомлений: [(кошелек, текст, чаты или None, события или None)]"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute(
+                    "SELECT id, wallet, message, chats, events FROM notifications WHERE delivered = 0 "
+                    "ORDER BY id LIMIT ?",
+                    (limit,)
+                ).fetchall()
+                if rows:
+                    self.conn.execute(
+                        f"UPDATE notifications SET delivered = 1 WHERE id IN ({','.join('?' * len(rows))})",
+                        [row[0] for row in rows]
+                    )
+                self.conn.execute(
+                    "DELETE FROM notifications WHERE delivered = 1 AND created < ?",
+                    (time.time() - BROKER_DEDUP_WINDOW,)
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return [
+            (
+                wallet, message,
+                json.loads(chats) if chats is not None else None,
+                [(Transaction.from_stored(row), line) for row, line in json.loads(events)] if events else None
+            )
+            for _, wallet, message, chats, events in rows
+        ]
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class WalletMonitor:
+    def __init__(self):
+        self.storage = create_storage()
+        (
+            self.wallets,
+            self.last_transactions,
+            self.chat_settings,
+            self.cursors  # Последняя обработанная транзакция (lt/hash) по кошельку
+        ) = self.storage.load()
+        self.migrate_wallet_keys()
+        self.seed_cursors_from_history()
+        self.address_book = AddressBookCache(self.storage)
+        self.jettons = JettonCache()
+        self.activity = ActivityView()
+        # Обратный индекс подписок: chat_id -> кошельки (dict как упорядоченное множество)
+        self.chat_wallets = {}
+        for wallet, chats in self.wallets.items():
+            for chat_id in chats:
+                self.chat_wallets.setdefault(chat_id, {})[wallet] = None
+        # Чаты с выключенными уведомлениями (по умолчанию уведомления включены)
+        self.muted_chats = {
+            chat_id for chat_id, settings in self.chat_settings.items()
+            if not settings.get('notifications', True)
+        }
+        self.chat_filters = {}  # (кошелек, chat_id) -> скомпилированный предикат фильтра подписки
+        self.compile_chat_filters()
+        # Чаты в режиме сводки: chat_id -> окно (секунды)
+        self.digest_windows = digest_windows(self.chat_settings)
+        self.digests = DigestBuffer()
+        self.checked_at = {}  # Время последней успешной проверки кошелька (unix time)
+        self.api = None
+        self.last_seqno = None  # Последний обработанный блок мастерчейна
+        self.scheduler = PollScheduler()
+        self.active_wallets = set()  # Кошельки с новыми транзакциями с момента последней проверки
+        self.transport = HttpTransport()
+        self.notifier = TelegramNotifier()
+        self.broker = None  # Брокер шардированного режима
+        self.worker_id = None  # Идентификатор воркера, если процесс - воркер шардированного режима
+        self.shard_nodes = []  # Живые воркеры при последнем обновлении шарда
+        self.bot_start_time = datetime.now()
+        # Кошельки с курсором, пропущенные транзакции которых еще не догнаны после рестарта
+        self.catchup_pending = set(self.cursors)
+    
+    def seed_cursors_from_history(self):
+        """Курсоры для кошельков из данных без курсоров: по самой новой сохраненной транзакции
+        
+        Так после обновления бота догоняются и транзакции, пришедшие за время простоя.
+        """
+        seeded = {}
+        for wallet in self.wallets:
+            if wallet not in self.cursors and self.last_transactions.get(wallet):
+                self.update_cursor(wallet, self.last_transactions[wallet], save=False)
+                seeded[wallet] = self.cursors[wallet]
+        if seeded:
+            self.storage.save_cursors(seeded)
+            logger.info(f"Курсоры восстановлены по истории для {len(seeded)} кошельков")
+    
+    def migrate_wallet_keys(self):
+        """Перевод кошельков, сохраненных в user-friendly форме, на канонические raw ключи
+        
+        Один и тот же кошелек, добавленный как EQ... и UQ..., объединяется.
+        """
+        for wallet in list(self.wallets):
+            try:
+                raw = normalize_address(wallet)
+            except ValueError:
+                logger.warning(f"Некорректный адрес кошелька в базе: {wallet}")
+                continue
+            if raw == wallet:
+                continue
+            
+            chats = self.wallets.pop(wallet)
+            target = self.wallets.setdefault(raw, {})
+            for chat_id, chat_info in chats.items():
+                if chat_id not in target:
+                    target[chat_id] = chat_info
+                    self.storage.save_subscription(raw, chat_info)
+            
+            transactions = self.last_transactions.pop(wallet, [])
+            if transactions and raw not in self.last_transactions:
+                self.last_transactions[raw] = transactions
+                self.storage.add_transactions(raw, transactions)
+            
+            cursor = self.cursors.pop(wallet, None)
+            if cursor and raw not in self.cursors:
+                self.cursors[raw] = cursor
+                self.storage.save_cursors({raw: cursor})
+            
+            self.storage.delete_wallet(wallet)
+            logger.info(f"Кошелек {wallet} переведен на raw адрес {raw}")
     
     def initialize_chat_settings(self, chat_id):
         """Инициализация настроек для чата"""
@@ -82,252 +2204,668 @@ class WalletMonitor:
                 'notifications': True,
                 'created_at': datetime.now().isoformat()
             }
-            self.save_chat_settings()
+            self.storage.save_chat_settings(str(chat_id), self.chat_settings[str(chat_id)])
     
     def add_wallet(self, chat_id, wallet_address, chat_type):
         """Добавление кошелька для мониторинга"""
         self.initialize_chat_settings(chat_id)
         
-        # Нормализуем адрес кошелька
-        wallet_address = wallet_address.strip()
+        # Кошельки хранятся по каноническому raw адресу (ValueError для некорректного адреса)
+        wallet_address = normalize_address(wallet_address)
         
-        if wallet_address not in self.wallets:
-            self.wallets[wallet_address] = []
+        chats = self.wallets.setdefault(wallet_address, {})
         
         # Проверяем, не добавлен ли уже этот чат для этого кошелька
-        chat_exists = any(chat['chat_id'] == str(chat_id) for chat in self.wallets[wallet_address])
+        if str(chat_id) in chats:
+            return False
         
-        if not chat_exists:
-            self.wallets[wallet_address].append({
-                'chat_id': str(chat_id),
-                'chat_type': chat_type,
-                'added_at': datetime.now().isoformat()
-            })
-            self.save_wallets()
-            return True
-        return False
+        chat_info = {
+            'chat_id': str(chat_id),
+            'chat_type': chat_type,
+            'added_at': datetime.now().isoformat()
+        }
+        chats[str(chat_id)] = chat_info
+        self.chat_wallets.setdefault(str(chat_id), {})[wallet_address] = None
+        self.activity.invalidate_chat(chat_id)
+        self.storage.save_subscription(wallet_address, chat_info)
+        if self.runs_scheduler():
+            self.scheduler.added.append(wallet_address)
+        return True
     
     def remove_wallet(self, chat_id, wallet_address):
         """Удаление кошелька из мониторинга для конкретного чата"""
-        wallet_address = wallet_address.strip()
+        try:
+            wallet_address = normalize_address(wallet_address)
+        except ValueError:
+            return False
         
-        if wallet_address in self.wallets:
+        chats = self.wallets.get(wallet_address)
+        if chats and str(chat_id) in chats:
             # Удаляем только этот чат из списка отслеживания кошелька
-            self.wallets[wallet_address] = [
-                chat for chat in self.wallets[wallet_address] 
-                if chat['chat_id'] != str(chat_id)
-            ]
+            del chats[str(chat_id)]
+            self.chat_filters.pop((wallet_address, str(chat_id)), None)
+            chat_wallets = self.chat_wallets.get(str(chat_id), {})
+            chat_wallets.pop(wallet_address, None)
+            if not chat_wallets:
+                self.chat_wallets.pop(str(chat_id), None)
+            self.activity.invalidate_chat(chat_id)
             
             # Если больше никто не отслеживает этот кошелек, удаляем его полностью
-            if not self.wallets[wallet_address]:
+            if not chats:
                 del self.wallets[wallet_address]
                 if wallet_address in self.last_transactions:
                     del self.last_transactions[wallet_address]
-            
-            self.save_wallets()
-            self.save_last_transactions()
+                self.checked_at.pop(wallet_address, None)
+                self.cursors.pop(wallet_address, None)
+                self.activity.forget(wallet_address)
+                self.storage.delete_wallet(wallet_address)
+            else:
+                self.storage.delete_subscription(wallet_address, chat_id)
             return True
         return False
     
+    def compile_chat_filters(self):
+        """Предикаты фильтров всех подписок (при загрузке и обновлении шарда)"""
+        self.chat_filters = {}
+        for wallet, chats in self.wallets.items():
+            for chat_id, chat_info in chats.items():
+                predicate = compile_filter(chat_info['filters']) if chat_info.get('filters') else None
+                if predicate is not None:
+                    self.chat_filters[(wallet, chat_id)] = predicate
+    
+    def set_filter(self, chat_id, wallet_address, rules):
+        """Правила фильтра подписки чата на кошелек (пустые - сброс); False, если подписки нет"""
+        try:
+            wallet_address = normalize_address(wallet_address)
+        except ValueError:
+            return False
+        chat_info = self.wallets.get(wallet_address, {}).get(str(chat_id))
+        if chat_info is None:
+            return False
+        
+        predicate = compile_filter(rules)
+        if rules:
+            chat_info['filters'] = rules
+        else:
+            chat_info.pop('filters', None)
+        if predicate is None:
+            self.chat_filters.pop((wallet_address, str(chat_id)), None)
+        else:
+            self.chat_filters[(wallet_address, str(chat_id))] = predicate
+        self.storage.save_subscription(wallet_address, chat_info)
+        return True
+    
+    def get_filter(self, chat_id, wallet_address):
+        """Правила фильтра подписки или None, если подписки нет"""
+        try:
+            wallet_address = normalize_address(wallet_address)
+        except ValueError:
+            return None
+        chat_info = self.wallets.get(wallet_address, {}).get(str(chat_id))
+        if chat_info is None:
+            return None
+        return chat_info.get('filters', {})
+    
     def get_chat_wallets(self, chat_id):
         """Получение списка кошельков для конкретного чата"""
-        chat_wallets = []
-        for wallet, chats in self.wallets.items():
-            if any(chat['chat_id'] == str(chat_id) for chat in chats):
-                chat_wallets.append(wallet)
-        return chat_wallets
+        return list(self.chat_wallets.get(str(chat_id), ()))
     
     def set_notifications(self, chat_id, status):
         """Включение/выключение уведомлений для чата"""
         self.initialize_chat_settings(chat_id)
         self.chat_settings[str(chat_id)]['notifications'] = status
-        self.save_chat_settings()
+        self.storage.save_chat_settings(str(chat_id), self.chat_settings[str(chat_id)])
+        if status:
+            self.muted_chats.discard(str(chat_id))
+        else:
+            self.muted_chats.add(str(chat_id))
         return status
     
-    def get_notifications_status(self, chat_id):
-        """Получение статуса уведомлений для чата"""
-        self.initialize_chat_settings(chat_id)
-        return self.chat_settings[str(chat_id)]['notifications']
+    def set_digest(self, chat_id, minutes):
+        """Окно сводки чата в минутах (0 - выключить; накопленное отправляется сразу)"""
+        self.initialize_chat_settings(chat_id)
+        settings = self.chat_settings[str(chat_id)]
+        if minutes:
+            settings['digest_window'] = minutes * 60
+            self.digest_windows[str(chat_id)] = minutes * 60
+        else:
+            settings.pop('digest_window', None)
+            self.digest_windows.pop(str(chat_id), None)
+            self.flush_digest(str(chat_id))
+        self.storage.save_chat_settings(str(chat_id), settings)
+    
+    def get_digest(self, chat_id):
+        """Окно сводки чата в минутах (0 - режим выключен)"""
+        return self.digest_windows.get(str(chat_id), 0) // 60
+    
+    def get_notifications_status(self, chat_id):
+        """Получение статуса уведомлений для чата (без записи настроек)"""
+        return str(chat_id) not in self.muted_chats
+    
+    def format_wallet_list(self, chat_id):
+        """Форматирование списка кошельков для отображения"""
+        wallets = self.get_chat_wallets(chat_id)
+        if not wallets:
+            return "📭 *Список кошельков пуст*\n\nДобавьте кошельки командой /addwallet"
+        
+        message = "👛 *Отслеживаемые кошельки:*\n\n"
+        for i, wallet in enumerate(wallets, 1):
+            message += f"{i}. `{to_user_friendly(wallet)}`\n\n"
+        
+        message += "🗑 *Удалить кошелек:* /removewallet <адрес>"
+        return message
+    
+    def render_wallet_activity(self, wallet):
+        """Фрагмент /lasttransactions: кошелек и его последние транзакции
+        
+        Фрагмент всегда помещается на страницу: транзакции, не вошедшие в лимит, отбрасываются.
+        """
+        fragment = f"👛 *Кошелек:* `{to_user_friendly(wallet)}`\n\n"
+        footer = "─" * 30 + "\n\n"
+        budget = TELEGRAM_MESSAGE_LIMIT - LAST_TX_HEADER_RESERVE - telegram_length(fragment + footer)
+        for tx in self.last_transactions.get(wallet, [])[:LAST_TX_PER_WALLET]:
+            line = f"{transaction_label(tx)} - {self.format_value(tx)}\n⏰ {format_time(tx.now)}\n\n"
+            budget -= telegram_length(line)
+            if budget < 0:
+                break
+            fragment += line
+        return fragment + footer
+    
+    async def refresh_chat_activity(self, chat_id):
+        """Бот шардированного режима: актуальные транзакции кошельков чата из хранилища
+        
+        Транзакции находят и сохраняют воркеры, поэтому по команде /lasttransactions
+        бот перечитывает их; кошельки с новыми транзакциями поднимаются в порядке чата.
+        Переключение страниц показывает этот же снимок без чтения хранилища.
+        """
+        if self.broker is None or self.worker_id is not None:
+            return
+        wallets = list(self.chat_wallets.get(str(chat_id), ()))
+        if not wallets:
+            return
+        stored, _ = await asyncio.to_thread(self.storage.load_wallet_state, wallets)
+        
+        changed = []
+        for wallet in wallets:
+            if wallet not in self.wallets:
+                continue  # Удален, пока шло чтение
+            transactions = stored.get(wallet, [])
+            current = self.last_transactions.get(wallet, [])
+            if (transactions[0].hash if transactions else None) != (current[0].hash if current else None):
+                self.last_transactions[wallet] = transactions
+                if transactions:
+                    changed.append(wallet)
+                else:
+                    self.activity.forget(wallet)
+        # Порядок чата - от старых изменений к новым, поэтому поднимаем по возрастанию lt
+        for wallet in sorted(changed, key=lambda wallet: self.last_transactions[wallet][0].lt):
+            self.activity.touch(wallet, self.wallets[wallet])
+    
+    def activity_page(self, chat_id, page):
+        """Страница /lasttransactions: (текст, номер страницы, число страниц) или None без транзакций"""
+        chat_id = str(chat_id)
+        fragments, page, pages = self.activity.page(
+            chat_id, self.chat_wallets.get(chat_id, ()), self.last_transactions,
+            self.render_wallet_activity, page, LAST_TX_PAGE_SIZE,
+            TELEGRAM_MESSAGE_LIMIT - LAST_TX_HEADER_RESERVE
+        )
+        if not fragments:
+            return None
+        
+        text = "📊 *Последние транзакции:*"
+        if pages > 1:
+            text += f" (стр. {page + 1}/{pages})"
+        return text + "\n\n" + "".join(fragments), page, pages
+    
+    def format_value(self, transaction):
+        """Сумма перевода: TON, токены jetton с их symbol и decimals или NFT"""
+        if not transaction.kind:
+            return format_amount(transaction.amount)
+        if transaction.kind == 'nft':
+            return self.address_book.link(transaction.asset)
+        token = self.jettons.token(transaction)
+        if token is None:
+            return f"{transaction.asset_amount} ({UNVERIFIED_JETTON_LABEL})"
+        return format_amount(transaction.asset_amount, token['decimals'], token['symbol'])
+    
+    def format_transaction_info(self, transaction):
+        """Форматирование информации о транзакции"""
+        message = TRANSACTION_TEMPLATE(
+            label=transaction_label(transaction),
+            amount=self.format_value(transaction),
+            source=self.address_book.link(transaction.source),
+            destination=self.address_book.link(transaction.destination),
+            time=format_time(transaction.now)
+        )
+        
+        # Добавляем комментарий только если он есть; разметка в нем экранируется
+        if transaction.comment:
+            message += COMMENT_TEMPLATE(transaction.comment.translate(MARKDOWN_ESCAPE))
+        
+        return message
+    
+    def refresh_shard(self):
+        """Обновление шарда воркера: отметка в брокере, состав воркеров и подписки
+        
+        Кошельки, перешедшие к воркеру, подгружаются из хранилища вместе с курсорами
+        предыдущего владельца; ушедшие к другим воркерам - выгружаются.
+        """
+        self.broker.heartbeat(self.worker_id)
+        nodes = self.broker.live_workers()
+        if nodes != self.shard_nodes:
+            logger.info(f"Воркеры шардированного режима: {', '.join(nodes)}")
+            self.shard_nodes = nodes
+        
+        ring = HashRing(nodes)
+        subscriptions, self.chat_settings = self.storage.load_subscriptions()
+        owned = {
+            wallet: chats for wallet, chats in subscriptions.items()
+            if ring.node_for(wallet) == self.worker_id
+        }
+        acquired = [wallet for wallet in owned if wallet not in self.wallets]
+        lost = [wallet for wallet in self.wallets if wallet not in owned]
+        
+        if acquired:
+            last_transactions, cursors = self.storage.load_wallet_state(acquired)
+            self.last_transactions.update(last_transactions)
+            self.cursors.update(cursors)
+            if self.runs_scheduler():
+                self.scheduler.added.extend(acquired)
+        for wallet in lost:
+            self.last_transactions.pop(wallet, None)
+            self.cursors.pop(wallet, None)
+            self.checked_at.pop(wallet, None)
+            self.catchup_pending.discard(wallet)
+            self.scheduler.remove(wallet)
+        
+        self.wallets = owned
+        self.muted_chats = {
+            chat_id for chat_id, settings in self.chat_settings.items()
+            if not settings.get('notifications', True)
+        }
+        self.compile_chat_filters()
+        self.digest_windows = digest_windows(self.chat_settings)
+        if acquired or lost:
+            logger.info(f"Шард {self.worker_id}: {len(owned)} кошельков (+{len(acquired)}, -{len(lost)})")
     
-    def format_wallet_list(self, chat_id):
-        """Форматирование списка кошельков для отображения"""
-        wallets = self.get_chat_wallets(chat_id)
-        if not wallets:
-            return "📭 *Список кошельков пуст*\n\nДобавьте кошельки командой /addwallet"
+    def runs_scheduler(self):
+        """Опрашивает ли этот процесс кошельки по расписанию (только он разбирает scheduler.added)
         
-        message = "👛 *Отслеживаемые кошельки:*\n\n"
-        for i, wallet in enumerate(wallets, 1):
-            message += f"{i}. `{wallet}`\n\n"
+        В шардированном режиме бот только доставляет уведомления, а блочный
+        и периодический опрос расписание не используют.
+        """
+        polls = self.broker is None or self.worker_id is not None
+        return polls and MONITOR_ENGINE != 'blocks' and ADAPTIVE_POLLING
+    
+    def reset_api_limits(self):
+        """Создание ограничителей запросов (внутри цикла событий, в котором они работают)"""
+        self.api = TonApiClient()
+    
+    async def check_transactions_async(self, client):
+        """Конкурентная проверка транзакций всех кошельков"""
+        all_wallets = list(self.wallets.keys())
+        if not all_wallets:
+            logger.info("Нет кошельков для проверки")
+            return
         
-        message += "🗑 *Удалить кошелек:* /removewallet <адрес>"
-        return message
+        await self.check_wallets_async(client, all_wallets)
     
-    def format_transaction_info(self, transaction, address_book):
-        """Форматирование информации о транзакции"""
+    async def check_wallets_async(self, client, all_wallets):
+        """Конкурентная проверка транзакций указанных кошельков"""
         try:
-            in_msg = transaction.get('in_msg', {})
-            out_msgs = transaction.get('out_msgs', [])
+            logger.debug(f"Проверяем транзакции для {len(all_wallets)} кошельков...")
+            started = time.monotonic()
             
-            # Определяем тип транзакции
-            if in_msg.get('source') and in_msg.get('destination'):
-                tx_type = "📥 Входящая"
-                amount = in_msg.get('value', '0')
-                from_addr = in_msg.get('source', 'Неизвестно')
-                to_addr = in_msg.get('destination', 'Неизвестно')
-                
-                # Получаем комментарий для входящей транзакции
-                comment = self.extract_comment(in_msg)
-                
-            elif out_msgs:
-                tx_type = "📤 Исходящая"
-                first_out_msg = out_msgs[0]
-                amount = first_out_msg.get('value', '0')
-                from_addr = transaction.get('account', 'Неизвестно')
-                to_addr = first_out_msg.get('destination', 'Неизвестно')
-                
-                # Получаем комментарий для исходящей транзакции
-                comment = self.extract_comment(first_out_msg)
+            if BATCH_POLLING and POLL_BATCH_SIZE > 1:
+                # В пакет попадают кошельки с недавней проверкой, остальные
+                # (новые или после перезапуска) догружаются по курсору отдельно
+                batched = [w for w in all_wallets if w in self.checked_at]
+                batched_set = set(batched)
+                single = [w for w in all_wallets if w not in batched_set]
             else:
-                tx_type = "🔁 Другая"
-                amount = '0'
-                from_addr = 'Неизвестно'
-                to_addr = 'Неизвестно'
-                comment = ""
-            
-            # Конвертируем наноТОН в TON
-            try:
-                amount_ton = int(amount) / 1e9
-                amount_str = f"{amount_ton:.4f} TON"
-            except:
-                amount_str = f"{amount} наноТОН"
-            
-            # Форматируем адреса с доменами и user-friendly форматом
-            def format_address_with_link(addr):
-                if addr == 'Неизвестно':
-                    return addr
-                
-                # Ищем в address_book
-                address_info = address_book.get(addr, {})
-                user_friendly = address_info.get('user_friendly', addr)
-                
-                # Определяем тип адреса по префиксу
-                if user_friendly.startswith('EQ'):
-                    addr_type = "EQ"
-                elif user_friendly.startswith('UQ'):
-                    addr_type = "UQ" 
-                elif user_friendly.startswith('0:'):
-                    addr_type = "RAW"
-                else:
-                    addr_type = "UNK"
-                
-                # Берем только первые 6 и последние 4 символа для отображения
-                if len(user_friendly) > 10:
-                    short_addr = user_friendly[:6] + "..." + user_friendly[-4:]
-                else:
-                    short_addr = user_friendly
-                
-                domain = address_info.get('domain')
-                
-                if domain:
-                    display_text = f"{domain} ({addr_type}:{short_addr})"
-                else:
-                    display_text = f"{addr_type}:{short_addr}"
-                
-                # Создаем ссылку на tonviewer
-                tonviewer_url = f"https://tonviewer.com/{user_friendly}"
-                
-                return f"[{display_text}]({tonviewer_url})"
-            
-            message = f"""
-{tx_type}
-💎 *Сумма:* {amount_str}
-👤 *От:* {format_address_with_link(from_addr)}
-🎯 *Кому:* {format_address_with_link(to_addr)}
-⏰ *Время:* {datetime.fromtimestamp(transaction.get('now', 0)).strftime('%d.%m.%Y %H:%M:%S')}
-"""
+                batched, single = [], all_wallets
             
-            # Добавляем комментарий только если он есть
-            if comment:
-                message += f"💬 *Комментарий:* {comment}\n"
-            
-            return message.strip()
+            tasks = [self.check_wallet_async(client, wallet) for wallet in single]
+            tasks += [
+                self.check_batch_async(client, batched[i:i + POLL_BATCH_SIZE])
+                for i in range(0, len(batched), POLL_BATCH_SIZE)
+            ]
+            await asyncio.gather(*tasks)
             
+            duration = time.monotonic() - started
+            metrics.observe('ton_monitor_sweep_seconds', duration)
+            metrics.inc('ton_monitor_wallet_checks_total', value=len(all_wallets))
+            logger.debug(f"Проверка {len(all_wallets)} кошельков заняла {duration:.1f} сек")
+        
         except Exception as e:
-            logger.error(f"Ошибка форматирования транзакции: {e}")
-            return f"❌ Ошибка обработки транзакции: {str(e)}"
+            logger.error(f"Ошибка при проверке транзакций: {e}")
+    
+    async def api_get(self, client, path, params):
+        """GET запрос к API через клиент с повторами и переключением эндпоинтов"""
+        return await self.api.get(client, path, params)
+    
+    async def fetch_new_transactions(self, client, wallet):
+        """Загрузка транзакций кошелька начиная с сохраненного курсора
+        
+        Без курсора запрашиваются последние 10 транзакций. С курсором
+        запрашиваются только транзакции с lt больше курсора, постранично
+        по возрастанию, пока не будет достигнут конец истории.
+        Возвращает (транзакции от новых к старым, address_book, загружено ли всё)
+        или None при ошибке.
+        """
+        cursor = self.cursors.get(wallet)
+        
+        if not cursor:
+            data = await self.api_get(client, TRANSACTIONS_PATH, {
+                'account': wallet,
+                'limit': 10,
+                'offset': 0,
+                'sort': 'desc'
+            })
+            if data is None:
+                return None
+            return parse_transactions(data.get('transactions', [])), data.get('address_book', {}), True
+        
+        transactions = []
+        address_book = {}
+        offset = 0
+        while True:
+            data = await self.api_get(client, TRANSACTIONS_PATH, {
+                'account': wallet,
+                'start_lt': int(cursor['lt']) + 1,
+                'limit': TX_PAGE_LIMIT,
+                'offset': offset,
+                'sort': 'asc'
+            })
+            if data is None:
+                # Частично загруженные страницы не теряются: курсор сдвинется только по ним
+                break
+            page = data.get('transactions', [])
+            transactions.extend(parse_transactions(page))
+            address_book.update(data.get('address_book', {}))
+            if len(page) < TX_PAGE_LIMIT:
+                break
+            offset += TX_PAGE_LIMIT
+        
+        complete = data is not None
+        if not complete and not transactions:
+            return None
+        
+        transactions.reverse()
+        return transactions, address_book, complete
+    
+    def update_cursor(self, wallet, transactions, save=True):
+        """Сдвиг курсора кошелька на самую новую из полученных транзакций
+        
+        Возвращает True, если курсор изменился.
+        """
+        newest = max(transactions, key=lambda tx: tx.lt)
+        cursor = self.cursors.get(wallet)
+        if cursor and int(cursor['lt']) >= newest.lt:
+            return False
+        
+        self.cursors[wallet] = {
+            'lt': str(newest.lt),
+            'hash': newest.hash,
+            'now': newest.now
+        }
+        if save:
+            self.storage.save_cursors({wallet: self.cursors[wallet]})
+        return True
     
-    def extract_comment(self, message_data):
-        """Извлечение комментария из сообщения (входящего или исходящего)"""
+    async def check_batch_async(self, client, wallets):
+        """Проверка группы кошельков одним запросом с несколькими account
+        
+        Запрашиваются транзакции группы начиная с самой ранней проверки
+        (start_utime с запасом), затем распределяются по кошелькам по полю
+        account и отсекаются по курсору каждого кошелька.
+        """
         try:
-            if not message_data:
-                return ""
+            started = time.time()
+            by_account = {wallet: [wallet] for wallet in wallets}
             
-            message_content = message_data.get('message_content', {})
-            decoded = message_content.get('decoded', {})
+            start_utime = int(min(self.checked_at[w] for w in wallets)) - BATCH_TIME_OVERLAP
+            logger.debug(f"Пакетный запрос для {len(wallets)} кошельков...")
             
-            if decoded.get('type') == 'text_comment':
-                return decoded.get('comment', '')
+            transactions = []
+            address_book = {}
+            offset = 0
+            while True:
+                data = await self.api_get(client, TRANSACTIONS_PATH, {
+                    'account': list(by_account),
+                    'start_utime': start_utime,
+                    'limit': TX_PAGE_LIMIT,
+                    'offset': offset,
+                    'sort': 'asc'
+                })
+                if data is None:
+                    # Без полной выборки не сдвигаем время проверки - повторим в следующий раз
+                    logger.error(f"Ошибка API для пакета из {len(wallets)} кошельков")
+                    return
+                page = data.get('transactions', [])
+                transactions.extend(parse_transactions(page))
+                address_book.update(data.get('address_book', {}))
+                if len(page) < TX_PAGE_LIMIT:
+                    break
+                offset += TX_PAGE_LIMIT
             
-            return ""
+            await self.dispatch_account_transactions(client, by_account, transactions, address_book)
+            for wallet in wallets:
+                if wallet in self.wallets:  # Кошелек мог быть удален командой, пока шли запросы
+                    self.checked_at[wallet] = started
+        
+        except httpx.HTTPError as e:
+            logger.error(f"Ошибка пакетного запроса: {e}")
         except Exception as e:
-            logger.error(f"Ошибка извлечения комментария: {e}")
-            return ""
+            logger.error(f"Общая ошибка пакетного запроса: {e}")
+    
+    async def prepare_address_book(self, client, transactions, address_book):
+        """Пополнение кэша адресов из ответа API и дозапрос только неизвестных адресов и jetton"""
+        self.address_book.update(address_book)
+        
+        addresses = set()
+        for tx in transactions:
+            addresses.add(tx.source)
+            addresses.add(tx.destination)
+            addresses.add(tx.account)
+            if tx.kind == 'nft':
+                addresses.add(tx.asset)
+        missing = self.address_book.missing(addresses)
+        
+        for i in range(0, len(missing), ADDRESS_BOOK_BATCH):
+            data = await self.api_get(client, ADDRESS_BOOK_PATH, {'address': missing[i:i + ADDRESS_BOOK_BATCH]})
+            if data:
+                self.address_book.update(data)
+        
+        await self.jettons.resolve(self, client, transactions)
+    
+    async def dispatch_account_transactions(self, client, by_account, transactions, address_book):
+        """Распределение транзакций (по возрастанию lt) по кошелькам через raw адрес
+        
+        by_account - соответствие raw адреса списку отслеживаемых кошельков.
+        Транзакции не новее курсора кошелька отбрасываются.
+        """
+        per_wallet = {}
+        for tx in transactions:
+            for wallet in by_account.get(tx.account, ()):
+                cursor = self.cursors.get(wallet)
+                if cursor is None or tx.lt > int(cursor['lt']):
+                    per_wallet.setdefault(wallet, []).append(tx)
+        
+        if per_wallet:
+            await self.prepare_address_book(
+                client, [tx for wallet_txs in per_wallet.values() for tx in wallet_txs], address_book
+            )
+        
+        moved = []
+        for wallet, wallet_txs in per_wallet.items():
+            if wallet not in self.wallets:
+                # Кошелек удален командой, пока шли запросы
+                continue
+            wallet_txs.reverse()  # От новых к старым
+            if debug_sampled():
+                logger.debug(f"Найдено {len(wallet_txs)} транзакций для {wallet[:8]}...")
+            self.process_transactions_for_wallet(wallet, wallet_txs)
+            if self.update_cursor(wallet, wallet_txs, save=False):
+                moved.append(wallet)
+        
+        if moved:
+            self.storage.save_cursors({wallet: self.cursors[wallet] for wallet in moved})
+    
+    def build_account_index(self):
+        """Индекс raw адрес -> кошельки для сопоставления транзакций из блоков"""
+        return {wallet: [wallet] for wallet in self.wallets}
+    
+    async def get_last_seqno(self, client):
+        """Номер последнего блока мастерчейна"""
+        data = await self.api_get(client, MASTERCHAIN_INFO_PATH, {})
+        if data is None:
+            return None
+        return data['last']['seqno']
+    
+    async def fetch_block_transactions(self, client, seqno):
+        """Все транзакции блока мастерчейна (включая шардовые блоки)"""
+        transactions = []
+        address_book = {}
+        offset = 0
+        while True:
+            data = await self.api_get(client, BLOCK_TRANSACTIONS_PATH, {
+                'seqno': seqno,
+                'limit': TX_PAGE_LIMIT,
+                'offset': offset,
+                'sort': 'asc'
+            })
+            if data is None:
+                return None
+            page = data.get('transactions', [])
+            transactions.extend(page)
+            address_book.update(data.get('address_book', {}))
+            if len(page) < TX_PAGE_LIMIT:
+                return transactions, address_book
+            offset += TX_PAGE_LIMIT
+    
+    async def check_blocks_async(self, client):
+        """Обработка новых блоков мастерчейна с последнего обработанного"""
+        last_seqno = await self.get_last_seqno(client)
+        if last_seqno is None:
+            return
+        
+        if self.last_seqno is None or last_seqno - self.last_seqno > MAX_BLOCK_CATCHUP:
+            # Старт или большое отставание: догоняем по курсорам кошельков
+            logger.info(f"Переход на блок {last_seqno} через проверку кошельков по курсорам")
+            await self.check_transactions_async(client)
+            self.last_seqno = last_seqno
+            return
+        
+        # Кошельки без завершенной проверки по курсору (новые или после ошибки API):
+        # транзакции из блоков им не раздаем, иначе курсор перескочит через пропуск
+        unsettled = [
+            wallet for wallet in self.wallets
+            if wallet in self.catchup_pending or wallet not in self.checked_at
+        ]
+        if last_seqno != self.last_seqno:
+            await self.dispatch_blocks(client, last_seqno, set(unsettled))
+        if unsettled:
+            await asyncio.gather(*(self.check_wallet_async(client, wallet) for wallet in unsettled))
+    
+    async def dispatch_blocks(self, client, last_seqno, unsettled):
+        """Загрузка блоков после обработанного и раздача их транзакций кошелькам"""
+        seqnos = range(self.last_seqno + 1, last_seqno + 1)
+        results = await asyncio.gather(*(self.fetch_block_transactions(client, n) for n in seqnos))
+        
+        index = {}
+        for account, wallets in self.build_account_index().items():
+            wallets = [wallet for wallet in wallets if wallet not in unsettled]
+            if wallets:
+                index[account] = wallets
+        matched = []
+        address_book = {}
+        for seqno, result in zip(seqnos, results):
+            if result is None:
+                # Повторим с этого блока на следующей итерации
+                logger.error(f"Не удалось загрузить транзакции блока {seqno}")
+                break
+            
+            block_transactions, block_address_book = result
+            block_matched = [
+                Transaction.from_api(tx) for tx in block_transactions if tx.get('account') in index
+            ]
+            if block_matched:
+                matched.extend(block_matched)
+                address_book.update(block_address_book)
+            self.last_seqno = seqno
+        
+        # Транзакции всех загруженных блоков обрабатываются одним пакетом на кошелек
+        if matched:
+            await self.dispatch_account_transactions(client, index, matched, address_book)
     
-    def check_transactions_sync(self):
-        """Синхронная версия проверки транзакций"""
+    async def check_wallet_async(self, client, wallet):
+        """Запрос и обработка транзакций одного кошелька"""
         try:
-            all_wallets = list(self.wallets.keys())
-            if not all_wallets:
-                logger.info("Нет кошельков для проверки")
+            if debug_sampled():
+                logger.debug(f"Запрос для кошелька: {wallet[:8]}...")
+            
+            started = time.time()
+            result = await self.fetch_new_transactions(client, wallet)
+            if result is None:
+                logger.error(f"Ошибка API для {wallet[:8]}")
                 return
             
-            logger.info(f"Проверяем транзакции для {len(all_wallets)} кошельков...")
+            transactions, address_book, complete = result
+            if wallet not in self.cursors:
+                # Первая проверка кошелька: история только сохраняется как точка отсчета
+                policy = 'skip'
+            elif wallet in self.catchup_pending:
+                # Транзакции, пришедшие, пока бот был выключен
+                policy = CATCHUP_POLICY
+            else:
+                policy = 'notify'
+            
+            if transactions:
+                if debug_sampled():
+                    logger.debug(f"Найдено {len(transactions)} транзакций для {wallet[:8]}...")
+                await self.prepare_address_book(client, transactions, address_book)
+                if wallet not in self.wallets:
+                    # Кошелек удален командой, пока шли запросы
+                    return
+                # Обрабатываем транзакции для этого кошелька
+                self.process_transactions_for_wallet(wallet, transactions, policy)
+                self.update_cursor(wallet, transactions)
+            else:
+                if wallet not in self.wallets:
+                    # Кошелек удален командой, пока шли запросы
+                    return
+                if debug_sampled():
+                    logger.debug(f"Нет новых транзакций для {wallet[:8]}...")
+                if complete and wallet not in self.cursors:
+                    # Пустой кошелек: первая же транзакция должна прийти уведомлением
+                    self.cursors[wallet] = {'lt': '0', 'hash': None, 'now': 0}
+                    self.storage.save_cursors({wallet: self.cursors[wallet]})
             
-            # Проверяем каждый кошелек отдельно
-            for wallet in all_wallets:
-                try:
-                    url = f"{TON_API_URL}?account={wallet}&limit=10&offset=0&sort=desc"
-                    
-                    logger.info(f"Запрос для кошелька: {wallet[:8]}...")
-                    
-                    response = requests.get(url, headers=API_HEADERS, timeout=30)
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        transactions = data.get('transactions', [])
-                        address_book = data.get('address_book', {})
-                        
-                        if transactions:
-                            logger.info(f"Найдено {len(transactions)} транзакций для {wallet[:8]}...")
-                            # Обрабатываем транзакции для этого кошелька
-                            self.process_transactions_for_wallet(wallet, transactions, address_book)
-                        else:
-                            logger.info(f"Нет новых транзакций для {wallet[:8]}...")
-                    else:
-                        logger.error(f"Ошибка API для {wallet[:8]}: {response.status_code}")
-                    
-                    # Пауза между запросами
-                    time.sleep(1)
-                    
-                except requests.RequestException as e:
-                    logger.error(f"Ошибка запроса для {wallet[:8]}: {e}")
-                except Exception as e:
-                    logger.error(f"Общая ошибка для {wallet[:8]}: {e}")
+            if complete:
+                self.checked_at[wallet] = started
+                self.catchup_pending.discard(wallet)
         
+        except httpx.HTTPError as e:
+            logger.error(f"Ошибка запроса для {wallet[:8]}: {e}")
         except Exception as e:
-            logger.error(f"Ошибка при проверке транзакций: {e}")
+            logger.error(f"Общая ошибка для {wallet[:8]}: {e}")
     
-    def process_transactions_for_wallet(self, wallet_address, transactions, address_book):
-        """Обработка транзакций для конкретного кошелька"""
+    def process_transactions_for_wallet(self, wallet_address, transactions, policy='notify'):
+        """Обработка транзакций для конкретного кошелька
+        
+        policy: 'notify' - уведомление о каждой транзакции, 'summary' - одна
+        сводка, 'skip' - только сохранение без уведомлений.
+        """
         try:
             # Сохраняем только новые транзакции
             existing_tx_hashes = set()
             if wallet_address in self.last_transactions:
-                existing_tx_hashes = {tx.get('hash') for tx in self.last_transactions[wallet_address]}
+                existing_tx_hashes = {tx.hash for tx in self.last_transactions[wallet_address]}
             
             new_transactions = []
             for tx in transactions:
-                tx_hash = tx.get('hash')
+                tx_hash = tx.hash
                 if tx_hash and tx_hash not in existing_tx_hashes:
                     new_transactions.append(tx)
             
@@ -340,54 +2878,250 @@ class WalletMonitor:
                 self.last_transactions[wallet_address] = new_transactions + self.last_transactions[wallet_address]
                 
                 # Ограничиваем количество сохраняемых транзакций
-                self.last_transactions[wallet_address] = self.last_transactions[wallet_address][:50]
-                
-                self.save_last_transactions()
-                logger.info(f"Сохранено {len(new_transactions)} новых транзакций для {wallet_address[:8]}...")
+                self.last_transactions[wallet_address] = self.last_transactions[wallet_address][:MAX_STORED_TRANSACTIONS]
                 
-                # На первом запуске не отправляем уведомления о старых транзакциях
-                if self.first_run:
-                    logger.info(f"Первый запуск - игнорируем {len(new_transactions)} старых транзакций")
-                    return  # Выходим из функции, не отправляем уведомления
+                self.storage.add_transactions(wallet_address, new_transactions[:MAX_STORED_TRANSACTIONS])
+                self.activity.touch(wallet_address, self.wallets.get(wallet_address, ()))
+                self.active_wallets.add(wallet_address)
+                metrics.inc('ton_monitor_transactions_total', (('policy', policy),), len(new_transactions))
+                if debug_sampled():
+                    logger.debug(f"Сохранено {len(new_transactions)} новых транзакций для {wallet_address[:8]}...")
                 
-                # Отправляем уведомления только о новых транзакциях
-                self.send_transaction_notifications(wallet_address, new_transactions, address_book)
+                if policy == 'skip':
+                    if debug_sampled():
+                        logger.debug(f"Без уведомлений сохранено {len(new_transactions)} транзакций для {wallet_address[:8]}...")
+                elif policy == 'summary':
+                    self.send_catchup_summary(wallet_address, new_transactions)
+                else:
+                    # Задержка обнаружения: от времени транзакции в блокчейне до ее обработки
+                    now = time.time()
+                    for tx in new_transactions:
+                        metrics.observe('ton_monitor_detection_lag_seconds', max(0, now - tx.now))
+                    # Отправляем уведомления только о новых транзакциях
+                    self.send_transaction_notifications(wallet_address, new_transactions)
         
         except Exception as e:
             logger.error(f"Ошибка обработки транзакций для {wallet_address[:8]}: {e}")
     
-    def send_transaction_notifications(self, wallet_address, transactions, address_book):
-        """Отправка уведомлений о новых транзакциях через синхронный HTTP запрос"""
+    def send_transaction_notifications(self, wallet_address, transactions):
+        """Отправка уведомлений о новых транзакциях через очередь доставки
+        
+        Фильтры подписок проверяются до форматирования; сообщение форматируется
+        один раз на каждый различный набор прошедших фильтры транзакций.
+        """
         try:
-            if wallet_address not in self.wallets:
-                return
-            
-            for chat_info in self.wallets[wallet_address]:
-                chat_id = chat_info['chat_id']
-                
-                # Проверяем, включены ли уведомления для этого чата
-                if self.get_notifications_status(int(chat_id)):
-                    # Форматируем user-friendly адрес для отображения
-                    wallet_info = address_book.get(wallet_address, {})
-                    wallet_display = wallet_info.get('user_friendly', wallet_address)
-                    
-                    # Сокращаем адрес кошелька для заголовка
-                    if len(wallet_display) > 10:
-                        short_wallet = wallet_display[:6] + "..." + wallet_display[-4:]
-                    else:
-                        short_wallet = wallet_display
-                    
-                    message = f"🔔 *Новые транзакции по кошельку:*\n`{short_wallet}`\n\n"
-                    
-                    for tx in transactions[:5]:  # Ограничиваем 5 транзакциями
-                        message += self.format_transaction_info(tx, address_book) + "\n\n" + "─" * 30 + "\n\n"
-                    
-                    # Отправляем сообщение через прямой HTTP запрос к Telegram API
-                    self.send_telegram_message_sync(chat_id, message)
+            for chats, selected in self.filter_recipients(wallet_address, transactions):
+                chats = self.buffer_digest(wallet_address, chats, selected)
+                if chats == []:
+                    continue
+                message = self.render_notification(wallet_address, selected)
+                self.deliver(wallet_address, message, selected[0].hash, chats, selected)
         
         except Exception as e:
             logger.error(f"Ошибка отправки уведомлений: {e}")
     
+    def send_catchup_summary(self, wallet_address, transactions):
+        """Одна сводка о транзакциях, пропущенных за время простоя бота"""
+        try:
+            for chats, selected in self.filter_recipients(wallet_address, transactions):
+                chats = self.buffer_digest(wallet_address, chats, selected)
+                if chats == []:
+                    continue
+                message = self.render_catchup_summary(wallet_address, selected)
+                self.deliver(wallet_address, message, selected[0].hash, chats, selected)
+        
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводки: {e}")
+    
+    def filter_recipients(self, wallet_address, transactions):
+        """Получатели, сгруппированные по транзакциям, прошедшим их фильтры: [(чаты или None, транзакции)]
+        
+        None вместо чатов - все подписчики без фильтров; чаты, для которых не прошла
+        ни одна транзакция, не получают уведомления.
+        """
+        recipients = self.notification_recipients(wallet_address)
+        if not recipients:
+            return []
+        
+        unfiltered = []
+        groups = {}  # Индексы прошедших транзакций -> чаты
+        for chat_id in recipients:
+            predicate = self.chat_filters.get((wallet_address, chat_id))
+            if predicate is None:
+                unfiltered.append(chat_id)
+                continue
+            selected = tuple(i for i, tx in enumerate(transactions) if predicate(tx))
+            if selected:
+                groups.setdefault(selected, []).append(chat_id)
+            else:
+                metrics.inc('ton_monitor_filtered_notifications_total')
+        
+        result = []
+        if unfiltered:
+            result.append((None if len(unfiltered) == len(recipients) else unfiltered, transactions))
+        for selected, chats in groups.items():
+            result.append((chats, [transactions[i] for i in selected]))
+        return result
+    
+    def buffer_digest(self, wallet_address, chats, transactions, events=None):
+        """Транзакции для чатов в режиме сводки откладываются в их сводки
+        
+        Возвращает чаты для немедленного уведомления (None - все подписчики, как в chats).
+        Сводка, набравшая DIGEST_MAX_EVENTS транзакций, отправляется сразу. Сводки копит
+        только бот: воркер передает транзакции вместе с уведомлением через брокер,
+        и бот объединяет события кошельков всех воркеров в одну сводку чата.
+        events - готовые пары (транзакция, строка сводки), например от воркера.
+        """
+        if self.worker_id is not None or not self.digest_windows:
+            return chats
+        recipients = chats if chats is not None else self.notification_recipients(wallet_address)
+        immediate = []
+        for chat_id in recipients:
+            if chat_id not in self.digest_windows:
+                immediate.append(chat_id)
+                continue
+            if events is None:
+                events = self.digest_events(transactions)
+            if self.digests.add(chat_id, wallet_address, events) >= DIGEST_MAX_EVENTS:
+                self.flush_digest(chat_id)
+        if chats is None and len(immediate) == len(recipients):
+            return None
+        return immediate
+    
+    def digest_events(self, transactions):
+        """Пары (транзакция, строка сводки); строки строит процесс, знающий токены и адреса"""
+        return [
+            (tx, f"{transaction_label(tx)} - {self.format_value(tx)}\n⏰ {format_time(tx.now)}\n")
+            for tx in transactions
+        ]
+    
+    def flush_digests(self, force=False):
+        """Отправка сводок с истекшим окном (force - всех накопленных, при остановке)"""
+        for chat_id in (list(self.digests.entries) if force else self.digests.due(self.digest_windows)):
+            self.flush_digest(chat_id)
+    
+    def flush_digest(self, chat_id):
+        """Отправка накопленной сводки чата одним сообщением"""
+        entry = self.digests.pop(chat_id)
+        if entry is None:
+            return
+        elapsed, wallets = entry
+        newest = max((events[0][0] for events in wallets.values()), key=lambda tx: tx.lt)
+        metrics.inc('ton_monitor_digests_total')
+        self.deliver(None, self.render_digest(elapsed, wallets), f"digest:{chat_id}:{newest.hash}", [chat_id])
+    
+    def render_digest(self, elapsed, wallets):
+        """Текст сводки: итоги по всем кошелькам и последние транзакции каждого
+        
+        Кошельки с самыми свежими транзакциями идут первыми; не поместившиеся
+        в лимит сообщения транзакции и кошельки показываются счетчиками.
+        """
+        transactions = [tx for events in wallets.values() for tx, _ in events]
+        # В итогах только переводы TON: суммы токенов в разных единицах не складываются
+        received = sum(tx.amount for tx in transactions if tx.direction == 'in' and not tx.kind)
+        sent = sum(tx.amount for tx in transactions if tx.direction == 'out' and not tx.kind)
+        
+        message = f"🗞 *Сводка за {max(1, round(elapsed / 60))} мин:*\n\n"
+        message += f"📊 Транзакций: {len(transactions)}, кошельков: {len(wallets)}\n"
+        message += f"📥 Получено: {format_amount(received)}\n"
+        message += f"📤 Отправлено: {format_amount(sent)}\n\n"
+        
+        ordered = sorted(wallets.items(), key=lambda item: item[1][0][0].lt, reverse=True)
+        for shown, (wallet, events) in enumerate(ordered):
+            section = f"👛 `{self.short_wallet_display(wallet)}` - {len(events)}\n"
+            for _, line in events[:DIGEST_WALLET_LATEST]:
+                section += line
+            if len(events) > DIGEST_WALLET_LATEST:
+                section += f"… и еще {len(events) - DIGEST_WALLET_LATEST}\n"
+            section += "\n"
+            # Оставляем место под строку о не поместившихся кошельках
+            if len(message) + len(section) > TELEGRAM_MESSAGE_LIMIT - 100:
+                message += f"… и еще кошельков: {len(ordered) - shown}\n"
+                break
+            message += section
+        return message
+    
+    def deliver(self, wallet_address, message, key, chats=None, transactions=None):
+        """Рассылка готового уведомления подписчикам кошелька
+        
+        Воркер шардированного режима передает уведомление через брокер вместе с
+        транзакциями (для сводок), а получателей по актуальным подпискам определяет бот.
+        key - хеш самой новой транзакции, chats - чаты, прошедшие фильтры (None - все
+        подписчики). Сводка чата передается без кошелька (wallet_address None)
+        и доставляется, если уведомления чата включены.
+        """
+        if self.worker_id is not None:
+            key = f"{wallet_address}:{key}" if chats is None else f"{wallet_address}:{key}:{chats[0]}"
+            events = None
+            if transactions:
+                events = [[tx.to_row(), line] for tx, line in self.digest_events(transactions)]
+            self.broker.publish(wallet_address, key, message, chats, events)
+            return
+        if not wallet_address:
+            recipients = [chat_id for chat_id in chats if chat_id not in self.muted_chats]
+        else:
+            recipients = self.notification_recipients(wallet_address)
+        if wallet_address and chats is not None:
+            chats = set(chats)
+            recipients = [chat_id for chat_id in recipients if chat_id in chats]
+        for chat_id in recipients:
+            self.send_telegram_message(chat_id, message)
+    
+    def notification_recipients(self, wallet_address):
+        """Чаты, подписанные на кошелек, с включенными уведомлениями"""
+        chats = self.wallets.get(wallet_address)
+        if not chats:
+            return []
+        return [chat_id for chat_id in chats if chat_id not in self.muted_chats]
+    
+    def short_wallet_display(self, wallet_address):
+        """Сокращенный user-friendly адрес кошелька для заголовка"""
+        wallet_info = self.address_book.get(wallet_address)
+        wallet_display = wallet_info.get('user_friendly') or to_user_friendly(wallet_address)
+        
+        if len(wallet_display) > 10:
+            return wallet_display[:6] + "..." + wallet_display[-4:]
+        return wallet_display
+    
+    def render_catchup_summary(self, wallet_address, transactions):
+        """Текст сводки о пропущенных транзакциях кошелька"""
+        short_wallet = self.short_wallet_display(wallet_address)
+        
+        # В итогах только переводы TON: суммы токенов в разных единицах не складываются
+        received = sum(tx.amount for tx in transactions if tx.direction == 'in' and not tx.kind)
+        sent = sum(tx.amount for tx in transactions if tx.direction == 'out' and not tx.kind)
+        
+        message = f"⏪ *Пропущено, пока бот был недоступен:*\n`{short_wallet}`\n\n"
+        message += f"📊 Транзакций: {len(transactions)}\n"
+        message += f"📥 Получено: {format_amount(received)}\n"
+        message += f"📤 Отправлено: {format_amount(sent)}\n\n"
+        message += "*Последние:*\n\n"
+        
+        for tx in transactions[:CATCHUP_SUMMARY_LATEST]:
+            message += self.format_transaction_info(tx) + "\n\n" + "─" * 30 + "\n\n"
+        
+        return message
+    
+    def render_notification(self, wallet_address, transactions):
+        """Текст уведомления о новых транзакциях кошелька"""
+        short_wallet = self.short_wallet_display(wallet_address)
+        
+        message = f"🔔 *Новые транзакции по кошельку:*\n`{short_wallet}`\n\n"
+        
+        for tx in transactions[:NOTIFICATION_MAX_TRANSACTIONS]:
+            message += self.format_transaction_info(tx) + "\n\n" + "─" * 30 + "\n\n"
+        
+        if len(transactions) > NOTIFICATION_MAX_TRANSACTIONS:
+            message += f"… и еще {len(transactions) - NOTIFICATION_MAX_TRANSACTIONS} транзакций\n"
+        return message
+    
+    def send_telegram_message(self, chat_id, message):
+        """Отправка сообщения: через очередь доставки, если она запущена"""
+        if self.notifier.running:
+            self.notifier.enqueue(chat_id, message)
+        else:
+            self.send_telegram_message_sync(chat_id, message)
+    
     def send_telegram_message_sync(self, chat_id, message):
         """Синхронная отправка сообщения через Telegram API"""
         try:
@@ -398,7 +3132,7 @@ class WalletMonitor:
                 'disable_web_page_preview': True
             }
             
-            response = requests.post(TELEGRAM_API_URL, json=payload, timeout=30)
+            response = self.transport.sync_session().post(TELEGRAM_API_URL, json=payload, timeout=API_TIMEOUT)
             
             if response.status_code == 200:
                 logger.info(f"Уведомление отправлено в чат {chat_id}")
@@ -423,10 +3157,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /addwallet <адрес> - Добавить кошелек
 /removewallet <адрес> - Удалить кошелек
 /listwallets - Список кошельков
+/filter <адрес> [правила] - Фильтр уведомлений
 
 🔔 *Уведомления:*
 /notifications_on - Включить уведомления
 /notifications_off - Выключить уведомления
+/digest <минуты> - Режим сводки
 
 📊 *Информация:*
 /lasttransactions - Последние транзакции
@@ -454,11 +3190,13 @@ async def add_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     wallet_address = context.args[0].strip()
     
-    # Простая валидация адреса TON
-    if not (wallet_address.startswith('EQ') or wallet_address.startswith('UQ')):
+    # Проверка адреса TON (формат и контрольная сумма)
+    try:
+        normalize_address(wallet_address)
+    except ValueError:
         await update.message.reply_text(
             "❌ *Неверный формат адреса!*\n\n"
-            "Адрес TON кошелька должен начинаться с `EQ` или `UQ`",
+            "Укажите адрес TON кошелька в формате `EQ...`/`UQ...` или `0:...`",
             parse_mode='Markdown'
         )
         return
@@ -518,6 +3256,70 @@ async def remove_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка удаления кошелька: {e}")
         await update.message.reply_text("❌ Ошибка при удалении кошелька")
 
+async def filter_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /filter"""
+    logger.info(f"Команда /filter от пользователя {update.effective_user.id}")
+    chat_id = update.effective_chat.id
+    
+    if not context.args:
+        await update.message.reply_text(
+            "❌ *Использование:* /filter <адрес> [правила]\n\n"
+            "*Правила:*\n"
+            "• `min=1.5` - сумма от 1.5 TON (переводы токенов не ограничивает)\n"
+            "• `dir=in` или `dir=out` - только входящие или исходящие\n"
+            "• `allow=<адрес>,<адрес>` - только с этими адресами\n"
+            "• `deny=<адрес>,<адрес>` - кроме этих адресов\n"
+            "• `comment=<слово>,<слово>` - комментарий содержит одно из слов, без учета регистра (последним)\n"
+            "• `off` - сбросить фильтр\n\n"
+            "Без правил - показать текущий фильтр.\n"
+            "*Пример:* /filter EQjsjsjj.... min=10 dir=in",
+            parse_mode='Markdown'
+        )
+        return
+    
+    wallet_address = context.args[0].strip()
+    rules_args = context.args[1:]
+    
+    try:
+        if not rules_args:
+            rules = monitor.get_filter(chat_id, wallet_address)
+            if rules is None:
+                await update.message.reply_text(
+                    f"❌ *Кошелек не найден!*\n\n"
+                    f"Кошелек `{wallet_address}` не отслеживается в этом чате.\n"
+                    f"📋 *Проверить список:* /listwallets",
+                    parse_mode='Markdown'
+                )
+                return
+            await update.message.reply_text(
+                f"🔎 *Фильтр кошелька* `{wallet_address}`:\n\n{describe_filter(rules)}",
+                parse_mode='Markdown'
+            )
+            return
+        
+        try:
+            rules = {} if rules_args == ['off'] else parse_filter_rules(rules_args)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        
+        if monitor.set_filter(chat_id, wallet_address, rules):
+            await update.message.reply_text(
+                f"✅ *Фильтр обновлен!*\n\n"
+                f"👛 *Адрес:* `{wallet_address}`\n\n{describe_filter(rules)}",
+                parse_mode='Markdown'
+            )
+        else:
+            await update.message.reply_text(
+                f"❌ *Кошелек не найден!*\n\n"
+                f"Кошелек `{wallet_address}` не отслеживается в этом чате.\n"
+                f"📋 *Проверить список:* /listwallets",
+                parse_mode='Markdown'
+            )
+    except Exception as e:
+        logger.error(f"Ошибка настройки фильтра: {e}")
+        await update.message.reply_text("❌ Ошибка при настройке фильтра")
+
 async def list_wallets(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /listwallets"""
     logger.info(f"Команда /listwallets от пользователя {update.effective_user.id}")
@@ -562,14 +3364,71 @@ async def notifications_off(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка выключения уведомлений: {e}")
         await update.message.reply_text("❌ Ошибка при выключении уведомлений")
 
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /digest"""
+    logger.info(f"Команда /digest от пользователя {update.effective_user.id}")
+    chat_id = update.effective_chat.id
+    
+    if not context.args:
+        minutes = monitor.get_digest(chat_id)
+        status = f"Включен, окно {minutes} мин" if minutes else "Выключен"
+        await update.message.reply_text(
+            f"🗞 *Режим сводки:* {status}\n\n"
+            f"Уведомления по всем кошелькам чата копятся и приходят одним сообщением раз в окно.\n\n"
+            f"*Использование:* /digest <минуты> или /digest off",
+            parse_mode='Markdown'
+        )
+        return
+    
+    value = context.args[0].strip().lower()
+    if value == 'off':
+        minutes = 0
+    elif value.isdigit() and 1 <= int(value) <= DIGEST_MAX_WINDOW:
+        minutes = int(value)
+    else:
+        await update.message.reply_text(
+            f"❌ *Использование:* /digest <минуты от 1 до {DIGEST_MAX_WINDOW}> или /digest off",
+            parse_mode='Markdown'
+        )
+        return
+    
+    try:
+        monitor.set_digest(chat_id, minutes)
+        if minutes:
+            await update.message.reply_text(
+                f"🗞 *Режим сводки включен!*\n\n"
+                f"Уведомления будут приходить одним сообщением раз в {minutes} мин.",
+                parse_mode='Markdown'
+            )
+        else:
+            await update.message.reply_text(
+                "🔔 *Режим сводки выключен!*\n\n"
+                "Уведомления снова приходят сразу по каждому кошельку.",
+                parse_mode='Markdown'
+            )
+    except Exception as e:
+        logger.error(f"Ошибка настройки сводки: {e}")
+        await update.message.reply_text("❌ Ошибка при настройке режима сводки")
+
+def activity_keyboard(page, pages):
+    """Кнопки переключения страниц /lasttransactions"""
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"lasttx:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"lasttx:{page}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"lasttx:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
 async def last_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /lasttransactions"""
     logger.info(f"Команда /lasttransactions от пользователя {update.effective_user.id}")
     chat_id = update.effective_chat.id
     
     try:
-        chat_wallets = monitor.get_chat_wallets(chat_id)
-        if not chat_wallets:
+        if not monitor.get_chat_wallets(chat_id):
             await update.message.reply_text(
                 "📭 *Нет отслеживаемых кошельков*\n\n"
                 "Добавьте кошельки командой /addwallet",
@@ -577,64 +3436,42 @@ async def last_transactions(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        # Получаем актуальные данные для форматирования
-        latest_transactions = {}
-        for wallet in chat_wallets:
-            if wallet in monitor.last_transactions:
-                # Берем последние транзакции
-                latest_tx = monitor.last_transactions[wallet][:3]
-                if latest_tx:
-                    latest_transactions[wallet] = latest_tx
-        
-        if not latest_transactions:
+        await monitor.refresh_chat_activity(chat_id)
+        result = monitor.activity_page(chat_id, 0)
+        if result is None:
             await update.message.reply_text(
                 "📭 *Транзакций пока нет*\n\nНовые транзакции появятся здесь после их обнаружения.",
                 parse_mode='Markdown'
             )
             return
         
-        message = "📊 *Последние транзакции:*\n\n"
-        
-        for wallet, tx_data in latest_transactions.items():
-            message += f"👛 *Кошелек:* `{wallet}`\n\n"
-            
-            for tx in tx_data:
-                # Для команды lasttransactions используем упрощенное форматирование
-                try:
-                    in_msg = tx.get('in_msg', {})
-                    out_msgs = tx.get('out_msgs', [])
-                    
-                    if in_msg.get('source') and in_msg.get('destination'):
-                        tx_type = "📥 Входящая"
-                        amount = in_msg.get('value', '0')
-                    elif out_msgs:
-                        tx_type = "📤 Исходящая" 
-                        amount = out_msgs[0].get('value', '0')
-                    else:
-                        tx_type = "🔁 Другая"
-                        amount = '0'
-                    
-                    try:
-                        amount_ton = int(amount) / 1e9
-                        amount_str = f"{amount_ton:.4f} TON"
-                    except:
-                        amount_str = f"{amount} наноТОН"
-                    
-                    message += f"{tx_type} - {amount_str}\n"
-                    message += f"⏰ {datetime.fromtimestamp(tx.get('now', 0)).strftime('%d.%m.%Y %H:%M:%S')}\n\n"
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка форматирования транзакции: {e}")
-                    message += "❌ Ошибка отображения транзакции\n\n"
-            
-            message += "─" * 30 + "\n\n"
-        
-        await update.message.reply_text(message, parse_mode='Markdown')
+        text, page, pages = result
+        await update.message.reply_text(text, parse_mode='Markdown', reply_markup=activity_keyboard(page, pages))
         
     except Exception as e:
         logger.error(f"Ошибка получения транзакций: {e}")
         await update.message.reply_text("❌ Ошибка при получении списка транзакций")
 
+async def last_transactions_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переключение страниц /lasttransactions"""
+    query = update.callback_query
+    await query.answer()
+    
+    try:
+        result = monitor.activity_page(query.message.chat_id, int(query.data.split(':')[1]))
+        if result is None:
+            await query.edit_message_text("📭 *Транзакций пока нет*", parse_mode='Markdown')
+            return
+        
+        text, page, pages = result
+        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=activity_keyboard(page, pages))
+    except BadRequest as e:
+        # Нажата кнопка текущей страницы - текст не изменился
+        if 'not modified' not in str(e):
+            logger.error(f"Ошибка переключения страницы: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка переключения страницы: {e}")
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     logger.info(f"Команда /help от пользователя {update.effective_user.id}")
@@ -645,10 +3482,12 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • `/addwallet <адрес>` - Добавить кошелек для отслеживания
 • `/removewallet <адрес>` - Удалить кошелек из отслеживания  
 • `/listwallets` - Показать все отслеживаемые кошельки
+• `/filter <адрес> [правила]` - Фильтр уведомлений по кошельку: `min=`, `dir=`, `allow=`, `deny=`, `comment=`, `off`
 
 🔔 *Управление уведомлениями:*
 • `/notifications_on` - Включить уведомления в этом чате
 • `/notifications_off` - Выключить уведомления в этом чате
+• `/digest <минуты>` - Уведомления одной сводкой раз в N минут (`/digest off` - выключить)
 
 📊 *Просмотр информации:*
 • `/lasttransactions` - Показать последние обнаруженные транзакции
@@ -664,52 +3503,237 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 3. Посмотреть список кошельков:
    `/listwallets`
 
-*Примечание:* Бот проверяет транзакции каждые 2 минуты
+*Примечание:* Активные кошельки проверяются чаще, неактивные - реже (до 10 минут)
     """
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
-def background_monitor():
-    """Фоновая задача для мониторинга транзакций"""
-    logger.info("Фоновый мониторинг запущен")
-    
-    # Первый запуск - пропускаем отправку уведомлений
-    monitor.first_run = True
-    logger.info("Первый запуск - игнорируем старые транзакции")
-    
-    # Ждем 10 секунд перед первой проверкой
-    time.sleep(10)
-    
+async def block_monitor_loop(client):
+    """Цикл сканирования новых блоков мастерчейна"""
+    while True:
+        try:
+            await monitor.check_blocks_async(client)
+            await asyncio.sleep(BLOCK_POLL_INTERVAL)
+        except Exception as e:
+            logger.error(f"Ошибка в фоновой задаче: {e}")
+            await asyncio.sleep(60)  # Ждем 1 минуту при ошибке
+
+async def poll_monitor_loop(client):
+    """Цикл периодического опроса всех кошельков"""
+    while True:
+        started = time.monotonic()
+        try:
+            await monitor.check_transactions_async(client)
+            
+            # Интервал отсчитывается от начала проверки
+            await asyncio.sleep(max(0, POLL_INTERVAL - (time.monotonic() - started)))
+        except Exception as e:
+            logger.error(f"Ошибка в фоновой задаче: {e}")
+            await asyncio.sleep(60)  # Ждем 1 минуту при ошибке
+
+async def adaptive_monitor_loop(client):
+    """Цикл опроса кошельков по индивидуальному расписанию"""
+    scheduler = monitor.scheduler
+    last_stats = time.monotonic()
     while True:
         try:
-            monitor.check_transactions_sync()
+            scheduler.sync(monitor.wallets)
+            now = time.monotonic()
+            due = scheduler.pop_due(now)
             
-            # После первой проверки снимаем флаг первого запуска
-            if monitor.first_run:
-                monitor.first_run = False
-                logger.info("Первый запуск завершен - теперь отправляем уведомления о новых транзакциях")
+            if due:
+                monitor.active_wallets.difference_update(due)
+                await monitor.check_wallets_async(client, due)
+                
+                now = time.monotonic()
+                for wallet in due:
+                    scheduler.reschedule(wallet, wallet in monitor.active_wallets, now)
+            
+            if now - last_stats >= POLL_INTERVAL:
+                last_stats = now
+                logger.info(f"Интервалы опроса: {scheduler.stats()}")
             
-            time.sleep(120)  # 2 минуты
+            # Просыпаемся не реже раза в секунду, чтобы быстро подхватить новые кошельки
+            await asyncio.sleep(min(1, scheduler.time_to_next(time.monotonic())))
         except Exception as e:
             logger.error(f"Ошибка в фоновой задаче: {e}")
-            time.sleep(60)  # Ждем 1 минуту при ошибке
+            await asyncio.sleep(60)  # Ждем 1 минуту при ошибке
+
+async def persist_loop():
+    """Цикл записи накопленных изменений хранилища"""
+    while True:
+        await asyncio.sleep(PERSIST_INTERVAL)
+        try:
+            monitor.storage.flush()
+        except Exception as e:
+            logger.error(f"Ошибка записи данных: {e}")
+
+async def digest_loop():
+    """Цикл отправки сводок чатов с истекшим окном"""
+    while True:
+        await asyncio.sleep(DIGEST_CHECK_INTERVAL)
+        try:
+            monitor.flush_digests()
+        except Exception as e:
+            logger.error(f"Ошибка отправки сводок: {e}")
+
+async def shard_refresh_loop():
+    """Цикл отметок воркера в брокере и перебалансировки шарда"""
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT)
+        try:
+            monitor.refresh_shard()
+        except Exception as e:
+            logger.error(f"Ошибка обновления шарда: {e}")
+
+async def delivery_stage_loop():
+    """Общий этап доставки: рассылка уведомлений воркеров подписчикам кошельков"""
+    while True:
+        try:
+            batch = await asyncio.to_thread(monitor.broker.consume)
+            for wallet, message, chats, events in batch:
+                if events:
+                    # Чаты в режиме сводки получают события в сводку бота, а не отдельное сообщение
+                    chats = monitor.buffer_digest(wallet, chats, [tx for tx, _ in events], events)
+                    if chats == []:
+                        continue
+                monitor.deliver(wallet, message, None, chats)
+            if len(batch) < BROKER_BATCH:
+                await asyncio.sleep(BROKER_POLL_INTERVAL)
+        except Exception as e:
+            logger.error(f"Ошибка этапа доставки: {e}")
+            await asyncio.sleep(BROKER_POLL_INTERVAL)
+
+def engine_loop(client):
+    """Цикл мониторинга согласно MONITOR_ENGINE и ADAPTIVE_POLLING"""
+    if MONITOR_ENGINE == 'blocks':
+        return block_monitor_loop(client)
+    if ADAPTIVE_POLLING:
+        return adaptive_monitor_loop(client)
+    return poll_monitor_loop(client)
+
+def register_gauges():
+    """Метрики текущего состояния монитора (вычисляются при запросе /metrics)"""
+    metrics.gauge('ton_monitor_wallets', lambda: len(monitor.wallets))
+    metrics.gauge('ton_monitor_delivery_queue', lambda: monitor.notifier.queue_size())
+    metrics.gauge('ton_monitor_delivery_chats', lambda: len(monitor.notifier.pending))
+    metrics.gauge('ton_monitor_scheduler_queue', lambda: len(monitor.scheduler.next_poll))
+    metrics.gauge('ton_monitor_catchup_pending', lambda: len(monitor.catchup_pending))
+    # Распределение интервалов адаптивного опроса (без кошельков в планировщике - не выводится)
+    for stat in ('min', 'median', 'max'):
+        metrics.gauge(f'ton_monitor_poll_interval_{stat}_seconds', lambda stat=stat: monitor.scheduler.stats()[stat])
+    metrics.gauge('ton_monitor_poll_active_wallets', lambda: monitor.scheduler.stats().get('active', 0))
+
+async def start_metrics_server(port=None):
+    """HTTP сервер метрик (по умолчанию на METRICS_PORT); None, если выключен или порт занят"""
+    if not METRICS_ENABLED:
+        return None
+    port = METRICS_PORT if port is None else port
+    register_gauges()
+    try:
+        server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, port)
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на {METRICS_HOST}:{port}: {e}")
+        return None
+    port = server.sockets[0].getsockname()[1]  # Порт 0 - свободный порт, выбранный ОС
+    logger.info(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+    return server
+
+def worker_metrics_port(worker_id):
+    """Порт метрик воркера по умолчанию: METRICS_PORT + 1 + ID для числовых ID, иначе свободный порт"""
+    if worker_id.isdigit():
+        return METRICS_PORT + 1 + int(worker_id)
+    logger.warning(f"Воркер {worker_id}: порт метрик выберет ОС, задайте его явно через --metrics-port")
+    return 0
+
+async def monitor_loop(metrics_port=None):
+    """Цикл проверок с долгоживущими HTTP клиентами"""
+    monitor.reset_api_limits()
+    await monitor.transport.start()
+    await monitor.notifier.start(monitor.transport.telegram)
+    metrics_server = await start_metrics_server(metrics_port)
+    try:
+        if monitor.worker_id is not None:
+            loops = [engine_loop(monitor.transport.toncenter), shard_refresh_loop()]
+        elif monitor.broker is not None:
+            # Кошельки опрашивают воркеры, бот только доставляет уведомления
+            loops = [delivery_stage_loop()]
+        else:
+            loops = [engine_loop(monitor.transport.toncenter)]
+        await asyncio.gather(persist_loop(), digest_loop(), *loops)
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        # Накопленные сводки отправляются через очередь доставки, которая затем доотправляется
+        monitor.flush_digests(force=True)
+        await monitor.notifier.stop()
+        await monitor.transport.close()
+
+async def start_monitor(application):
+    """Запуск мониторинга в цикле событий приложения
+    
+    Мониторинг и обработчики команд работают в одном цикле событий, поэтому
+    состояние монитора меняется только между точками await и без блокировок.
+    """
+    logger.info("Фоновый мониторинг запущен")
+    if monitor.catchup_pending and monitor.broker is None:
+        logger.info(f"Догоняем пропущенные транзакции для {len(monitor.catchup_pending)} кошельков ({CATCHUP_POLICY})")
+    
+    application.bot_data['monitor_task'] = asyncio.create_task(monitor_loop())
+
+async def stop_monitor(application):
+    """Остановка мониторинга с закрытием HTTP клиентов и очереди доставки"""
+    task = application.bot_data.pop('monitor_task', None)
+    if task is not None:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    monitor.storage.close()
+
+def run_worker(worker_id, metrics_port=None):
+    """Процесс-воркер шардированного режима: опрос своей части кошельков"""
+    if STORAGE_BACKEND != 'sqlite':
+        logger.error("Шардированный режим требует STORAGE_BACKEND = 'sqlite'")
+        return
+    
+    monitor.broker = SqliteBroker()
+    monitor.worker_id = worker_id
+    monitor.refresh_shard()
+    logger.info(f"Воркер {worker_id} запущен")
+    try:
+        if metrics_port is None:
+            metrics_port = worker_metrics_port(worker_id)
+        asyncio.run(monitor_loop(metrics_port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.broker.leave(worker_id)
+        monitor.broker.close()
+        monitor.storage.close()
 
 def main():
     """Основная функция"""
-    # Запускаем фоновый мониторинг в отдельном потоке
-    monitor_thread = threading.Thread(target=background_monitor, daemon=True)
-    monitor_thread.start()
+    if SHARDING_ENABLED:
+        monitor.broker = SqliteBroker()
     
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Создаем приложение; мониторинг запускается в его цикле событий
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(start_monitor)
+        .post_shutdown(stop_monitor)
+        .build()
+    )
     
     # Добавляем обработчики команд - ТОЛЬКО для команд начинающихся с /
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("addwallet", add_wallet))
     application.add_handler(CommandHandler("removewallet", remove_wallet))
     application.add_handler(CommandHandler("listwallets", list_wallets))
+    application.add_handler(CommandHandler("filter", filter_command))
     application.add_handler(CommandHandler("notifications_on", notifications_on))
     application.add_handler(CommandHandler("notifications_off", notifications_off))
+    application.add_handler(CommandHandler("digest", digest_command))
     application.add_handler(CommandHandler("lasttransactions", last_transactions))
+    application.add_handler(CallbackQueryHandler(last_transactions_page, pattern=r'^lasttx:\d+$'))
     application.add_handler(CommandHandler("help", help_command))
     
     # НЕ добавляем обработчик неизвестных команд - бот будет игнорировать чужие команды
@@ -717,14 +3741,25 @@ def main():
     # Запускаем бота
     print("🤖 Бот запущен...")
     print("📊 Мониторинг транзакций активен")
-    print("⏰ Проверка каждые 2 минуты")
+    if ADAPTIVE_POLLING:
+        print(f"⏰ Адаптивная проверка: от {POLL_MIN_INTERVAL} до {POLL_MAX_INTERVAL} секунд")
+    else:
+        print(f"⏰ Проверка каждые {POLL_INTERVAL} секунд")
     print("💫 Ожидаем команды...")
     print("🔧 Для теста отправьте /start боту в Telegram")
     print("🚫 Бот игнорирует команды других ботов")
-    print("🆕 При запуске игнорируются старые транзакции")
+    print(f"⏪ Пропущенные за время простоя транзакции: {CATCHUP_POLICY}")
+    if SHARDING_ENABLED:
+        print("🧩 Шардированный режим: кошельки опрашивают воркеры (python main.py --worker ID [--metrics-port PORT])")
     
     # Запускаем поллинг
     application.run_polling()
 
 if __name__ == "__main__":
-    main()
+    args = sys.argv[1:]
+    if len(args) == 2 and args[0] == '--worker':
+        run_worker(args[1])
+    elif len(args) == 4 and args[0] == '--worker' and args[2] == '--metrics-port' and args[3].isdigit():
+        run_worker(args[1], int(args[3]))
+    else:
+        main()
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# main.py создает монитор и хранилище при импорте - импортируем из временного каталога
+os.chdir(tempfile.mkdtemp(prefix="ton-monitor-tests-"))
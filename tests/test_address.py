@@ -0,0 +1,104 @@
+"""Кодек адресов TON: raw и user-friendly формы, контрольная сумма, флаги"""
+import base64
+
+import pytest
+
+import main
+
+# Известные адреса: (raw, bounceable user-friendly)
+KNOWN_ADDRESSES = [
+    ("0:83DFD552E63729B472FCBCC8C45EBCC6691702558B68EC7527E1BA403A0F31A8",
+     "EQCD39VS5jcptHL8vMjEXrzGaRcCVYto7HUn4bpAOg8xqB2N"),
+    ("0:0000000000000000000000000000000000000000000000000000000000000000",
+     "EQAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAM9c"),
+    ("-1:3333333333333333333333333333333333333333333333333333333333333333",
+     "Ef8zMzMzMzMzMzMzMzMzMzMzMzMzMzMzMzMzMzMzMzMzM0vF"),
+]
+
+
+def user_friendly(tag, workchain, account, crc=None):
+    """User-friendly адрес с произвольным тегом (и, при необходимости, контрольной суммой)"""
+    data = bytes([tag]) + workchain.to_bytes(1, 'big', signed=True) + account
+    crc = main.crc16(data) if crc is None else crc
+    return base64.urlsafe_b64encode(data + crc.to_bytes(2, 'big')).decode()
+
+
+def test_crc16_xmodem_check_value():
+    assert main.crc16(b"123456789") == 0x31C3
+
+
+@pytest.mark.parametrize("raw, bounceable", KNOWN_ADDRESSES)
+def test_known_addresses(raw, bounceable):
+    assert main.normalize_address(bounceable) == raw
+    assert main.to_user_friendly(raw, bounceable=True) == bounceable
+
+
+@pytest.mark.parametrize("raw, bounceable", KNOWN_ADDRESSES)
+def test_round_trip_through_every_form(raw, bounceable):
+    for is_bounceable in (False, True):
+        for testnet in (False, True):
+            address = main.to_user_friendly(raw, bounceable=is_bounceable, testnet=testnet)
+            assert len(address) == 48
+            assert main.normalize_address(address) == raw
+
+
+def test_forms_of_one_wallet_are_equivalent():
+    raw = KNOWN_ADDRESSES[0][0]
+    forms = [
+        raw,
+        raw.lower(),
+        f"  {raw}  ",
+        main.to_user_friendly(raw),  # UQ
+        main.to_user_friendly(raw, bounceable=True),  # EQ
+        main.to_user_friendly(raw, testnet=True),  # 0Q
+        main.to_user_friendly(raw, bounceable=True, testnet=True),  # kQ
+        # Стандартный base64 (с + и /) вместо base64url
+        main.to_user_friendly(raw, bounceable=True).replace('-', '+').replace('_', '/'),
+    ]
+    assert [form[:2] for form in forms[3:7]] == ["UQ", "EQ", "0Q", "kQ"]
+    assert {main.normalize_address(form) for form in forms} == {raw}
+
+
+def test_user_friendly_prefixes():
+    raw = KNOWN_ADDRESSES[1][0]
+    assert main.to_user_friendly(raw).startswith("UQ")
+    assert main.to_user_friendly(raw, bounceable=True).startswith("EQ")
+
+
+def test_bad_checksum_is_rejected():
+    address = KNOWN_ADDRESSES[0][1]
+    # Другой символ в середине адреса - контрольная сумма не сходится
+    broken = address[:10] + ('A' if address[10] != 'A' else 'B') + address[11:]
+    with pytest.raises(ValueError):
+        main.parse_address(broken)
+    with pytest.raises(ValueError):
+        main.parse_address(user_friendly(0x11, 0, bytes(32), crc=0))
+
+
+@pytest.mark.parametrize("address", [
+    KNOWN_ADDRESSES[0][1][:-1],
+    KNOWN_ADDRESSES[0][1] + "A",
+    "",
+    "0:83DFD552",
+    "0:" + "00" * 33,
+])
+def test_bad_length_is_rejected(address):
+    with pytest.raises(ValueError):
+        main.parse_address(address)
+
+
+@pytest.mark.parametrize("tag", [0x00, 0x12, 0x50, 0x91 ^ 0x01])
+def test_unknown_tag_is_rejected(tag):
+    with pytest.raises(ValueError):
+        main.parse_address(user_friendly(tag, 0, bytes(range(32))))
+
+
+def test_testnet_flag_is_accepted_with_both_tags():
+    for tag in (0x91, 0xD1):
+        assert main.parse_address(user_friendly(tag, 0, bytes(32))) == (0, bytes(32))
+
+
+@pytest.mark.parametrize("address", ["0:" + "ZZ" * 32, "x:" + "00" * 32])
+def test_malformed_raw_is_rejected(address):
+    with pytest.raises(ValueError):
+        main.parse_address(address)
@@ -0,0 +1,93 @@
+"""Повторы и выключатели клиента toncenter (на фейковом транспорте httpx)"""
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(main, 'API_BACKOFF_BASE', 0)
+
+
+def make_api():
+    api = main.TonApiClient(endpoints=[{'url': "http://toncenter.test/api/v3", 'rps': 1000}])
+    return api, api.endpoints[0]
+
+
+def run(api, statuses):
+    """Запрос через транспорт, отвечающий статусами из списка; возвращает (результат, число запросов)"""
+    calls = []
+    
+    def handler(request):
+        calls.append(request)
+        status = statuses.pop(0) if statuses else 200
+        return httpx.Response(status, json={'transactions': []})
+    
+    async def request():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await api.get(client, "/transactions", {})
+    return asyncio.run(request()), len(calls)
+
+
+def open_breaker(api, endpoint):
+    failures = [500] * main.BREAKER_FAILURE_THRESHOLD
+    while failures:
+        assert run(api, failures)[0] is None
+    assert endpoint.breaker.state == 'open'
+    endpoint.breaker.reset_timeout = 0
+
+
+def test_half_open_probe_answered_with_429_closes_breaker():
+    api, endpoint = make_api()
+    open_breaker(api, endpoint)
+    
+    # Пробный запрос получает 429, повтор - уже здоровый ответ
+    result, calls = run(api, [429])
+    assert result == {'transactions': []}
+    assert calls == 2
+    assert endpoint.breaker.state == 'closed'
+    
+    result, calls = run(api, [])
+    assert (result, calls) == ({'transactions': []}, 1)
+
+
+def test_half_open_probe_answered_with_4xx_closes_breaker():
+    api, endpoint = make_api()
+    open_breaker(api, endpoint)
+    assert run(api, [400]) == (None, 1)
+    assert endpoint.breaker.state == 'closed'
+    assert run(api, []) == ({'transactions': []}, 1)
+
+
+def test_cancelled_probe_reopens_breaker():
+    api, endpoint = make_api()
+    open_breaker(api, endpoint)
+    
+    async def handler(request):
+        await asyncio.sleep(10)
+    
+    async def cancelled_probe():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            task = asyncio.create_task(api.get(client, "/transactions", {}))
+            await asyncio.sleep(0.01)
+            assert endpoint.breaker.state == 'half_open'
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+    asyncio.run(cancelled_probe())
+    
+    assert endpoint.breaker.state == 'open'
+    assert run(api, []) == ({'transactions': []}, 1)
+    assert endpoint.breaker.state == 'closed'
+
+
+def test_failed_probe_reopens_breaker():
+    api, endpoint = make_api()
+    open_breaker(api, endpoint)
+    endpoint.breaker.reset_timeout = 60
+    endpoint.breaker.opened_at -= 60
+    assert run(api, [500]) == (None, 1)
+    assert endpoint.breaker.state == 'open'
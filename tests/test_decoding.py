@@ -0,0 +1,345 @@
+"""Разбор BOC и обработчики opcode для сообщений jetton и NFT"""
+import base64
+
+import pytest
+
+import main
+
+OWNER = "0:" + "11" * 32
+JETTON_WALLET = "0:" + "22" * 32
+SENDER = "0:" + "33" * 32
+NFT_ITEM = "-1:" + "44" * 32
+# jetton transfer_notification: query_id=7, 1.5 USDT (1500000), от SENDER, комментарий "hi" в теле
+NOTIFY_BODY = "te6cckECAQEAADkAAG5zYtCcAAAAAAAAAAcxbjYIAGZmZmZmZmZmZmZmZmZmZmZmZmZmZmZmZmZmZmZmZmZmAAAAAGhpu3YRtw=="
+
+
+class Builder:
+    """Эталонная сборка ячеек (независимо от парсера в main.py)"""
+    
+    def __init__(self):
+        self.bits = ""
+        self.refs = []
+    
+    def uint(self, value, bits):
+        self.bits += format(value, f"0{bits}b") if bits else ""
+        return self
+    
+    def coins(self, value):
+        length = (value.bit_length() + 7) // 8
+        return self.uint(length, 4).uint(value, length * 8)
+    
+    def address(self, address):
+        if not address:
+            return self.uint(0, 2)
+        workchain, account = address.split(":")
+        return self.uint(2, 2).uint(0, 1).uint(int(workchain) & 0xFF, 8).uint(int(account, 16), 256)
+    
+    def text(self, text):
+        for byte in text.encode():
+            self.uint(byte, 8)
+        return self
+    
+    def ref(self, cell):
+        self.refs.append(cell)
+        return self
+
+
+def serialize(root, with_index=False, with_crc=False, size=1):
+    """BOC с одной корневой ячейкой; ячейки упорядочены так, что ссылки идут вперед"""
+    order = []
+    
+    def visit(cell):
+        if cell not in order:
+            order.append(cell)
+            for ref in cell.refs:
+                visit(ref)
+    visit(root)
+    
+    cells = []
+    for cell in order:
+        full, rest = divmod(len(cell.bits), 8)
+        bits = cell.bits + ("1" + "0" * (7 - rest) if rest else "")
+        data = int(bits, 2).to_bytes(len(bits) // 8, "big") if bits else b""
+        refs = b"".join(order.index(ref).to_bytes(size, "big") for ref in cell.refs)
+        cells.append(bytes([len(cell.refs), full * 2 + (1 if rest else 0)]) + data + refs)
+    
+    total = sum(map(len, cells))
+    offset_size = 2
+    flags = (0x80 if with_index else 0) | (0x40 if with_crc else 0) | size
+    boc = bytes.fromhex("b5ee9c72") + bytes([flags, offset_size])
+    boc += len(cells).to_bytes(size, "big") + (1).to_bytes(size, "big") + (0).to_bytes(size, "big")
+    boc += total.to_bytes(offset_size, "big") + (0).to_bytes(size, "big")
+    if with_index:
+        offset = 0
+        for cell in cells:
+            offset += len(cell)
+            boc += offset.to_bytes(offset_size, "big")
+    boc += b"".join(cells)
+    if with_crc:
+        boc += crc32c(boc).to_bytes(4, "little")
+    return boc
+
+
+def crc32c(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0x82F63B78 if crc & 1 else 0)
+    return crc ^ 0xFFFFFFFF
+
+
+def encode(root, **kwargs):
+    return base64.b64encode(serialize(root, **kwargs)).decode()
+
+
+def comment_cell(text):
+    return Builder().uint(0, 32).text(text)
+
+
+def api_tx(message, direction='in'):
+    """Транзакция в формате toncenter v3 с единственным сообщением"""
+    tx = {'hash': "aGFzaA==", 'lt': "100", 'now': 1700000000, 'account': OWNER}
+    if direction == 'in':
+        tx['in_msg'] = message
+    else:
+        tx['in_msg'] = {'source': None, 'destination': OWNER}
+        tx['out_msgs'] = [message]
+    return tx
+
+
+def incoming(body, source=JETTON_WALLET, opcode=None):
+    message = {'source': source, 'destination': OWNER, 'value': "50000000",
+               'message_content': {'body': body}}
+    if opcode is not None:
+        message['opcode'] = opcode
+    return main.Transaction.from_api(api_tx(message))
+
+
+def outgoing(body, destination=JETTON_WALLET, opcode=None):
+    message = {'source': OWNER, 'destination': destination, 'value': "50000000",
+               'message_content': {'body': body}}
+    if opcode is not None:
+        message['opcode'] = opcode
+    return main.Transaction.from_api(api_tx(message, direction='out'))
+
+
+def notify_body(amount=1500000, sender=SENDER, payload=None, inline=True):
+    body = Builder().uint(main.OP_JETTON_NOTIFY, 32).uint(7, 64).coins(amount).address(sender)
+    if payload is None:
+        return body.uint(0, 1)
+    if inline:
+        body.uint(0, 1).bits += payload.bits
+        body.refs += payload.refs
+        return body
+    return body.uint(1, 1).ref(payload)
+
+
+# BOC
+
+
+@pytest.mark.parametrize("options", [{}, {'with_index': True}, {'with_crc': True},
+                                     {'with_index': True, 'with_crc': True, 'size': 2}])
+def test_parse_boc_serialization_variants(options):
+    child = Builder().uint(0xABC, 12)
+    root = Builder().uint(1, 1).uint(0, 2).ref(child).ref(Builder())
+    cell = main.parse_boc(serialize(root, **options))
+    assert (cell.value, cell.bits) == (0b100, 3)
+    assert (cell.refs[0].value, cell.refs[0].bits) == (0xABC, 12)
+    assert (cell.refs[1].value, cell.refs[1].bits, cell.refs[1].refs) == (0, 0, [])
+
+
+def test_parse_boc_shared_cells():
+    shared = Builder().uint(0xFF, 8)
+    cell = main.parse_boc(serialize(Builder().ref(shared).ref(shared)))
+    assert cell.refs[0] is cell.refs[1]
+
+
+def test_known_notify_body():
+    assert encode(notify_body(payload=comment_cell("hi")), with_crc=True) == NOTIFY_BODY
+    tx = incoming(NOTIFY_BODY)
+    assert (tx.kind, tx.asset, tx.asset_amount) == ('jetton', JETTON_WALLET, 1500000)
+    assert (tx.source, tx.destination, tx.comment) == (SENDER, OWNER, "hi")
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"\xb5\xee\x9c",
+    bytes.fromhex("b5ee9c73") + bytes(10),  # другая магия
+    serialize(Builder().uint(5, 8))[:-1],  # обрыв данных ячейки
+    serialize(Builder().ref(Builder().uint(1, 8)))[:12],  # обрыв в заголовках ячеек
+])
+def test_parse_boc_rejects_truncated_and_foreign_data(data):
+    with pytest.raises(ValueError):
+        main.parse_boc(data)
+
+
+def test_parse_boc_rejects_backward_and_missing_refs():
+    boc = bytearray(serialize(Builder().ref(Builder().uint(1, 8))))
+    # Заголовок 12 байт, затем корень: d1, d2, индекс ссылки
+    assert boc[12:15] == b"\x01\x00\x01"
+    for index in (0, 2):
+        boc[14] = index
+        with pytest.raises(ValueError):
+            main.parse_boc(bytes(boc))
+
+
+def test_parse_boc_rejects_bad_padding():
+    boc = bytearray(serialize(Builder().uint(1, 4)))
+    boc[-1] = 0  # неполный байт без завершающего бита
+    with pytest.raises(ValueError):
+        main.parse_boc(bytes(boc))
+
+
+def test_slice_reads_past_end():
+    body = main.Slice(main.parse_boc(serialize(Builder().uint(3, 4))))
+    assert body.load_uint(2) == 0
+    with pytest.raises(ValueError):
+        body.load_uint(3)
+    with pytest.raises(ValueError):
+        body.load_ref()
+
+
+def test_slice_addresses():
+    cell = Builder().address(NFT_ITEM).address("").uint(1, 2).uint(8, 9).uint(0xAB, 8).uint(3, 2)
+    body = main.Slice(main.parse_boc(serialize(cell)))
+    assert body.load_address() == NFT_ITEM
+    assert body.load_address() == ""
+    assert body.load_address() == ""  # addr_extern
+    with pytest.raises(ValueError):
+        body.load_address()  # addr_var
+
+
+def test_snake_text_across_refs():
+    tail = Builder().text(" мир")
+    payload = comment_cell("Привет,").ref(tail)
+    tx = incoming(encode(notify_body(payload=payload, inline=False)))
+    assert tx.comment == "Привет, мир"
+
+
+# Обработчики opcode
+
+
+def test_all_opcodes_have_handlers():
+    assert set(main.OPCODE_HANDLERS) == {
+        main.OP_JETTON_NOTIFY, main.OP_JETTON_TRANSFER, main.OP_JETTON_BURN,
+        main.OP_NFT_TRANSFER, main.OP_NFT_OWNERSHIP_ASSIGNED,
+    }
+
+
+@pytest.mark.parametrize("inline", [True, False])
+def test_jetton_notify(inline):
+    body = encode(notify_body(amount=10 ** 18, payload=comment_cell("заказ 42"), inline=inline))
+    tx = incoming(body, opcode="0x7362d09c")
+    assert (tx.kind, tx.asset, tx.asset_amount) == ('jetton', JETTON_WALLET, 10 ** 18)
+    assert (tx.direction, tx.source, tx.comment) == ('in', SENDER, "заказ 42")
+    assert tx.amount == 50000000
+
+
+def test_jetton_notify_without_comment():
+    tx = incoming(encode(notify_body()))
+    assert (tx.kind, tx.source, tx.comment) == ('jetton', SENDER, "")
+
+
+def test_jetton_notify_with_binary_payload():
+    payload = Builder().uint(0xDEADBEEF, 32).uint(1, 8)
+    tx = incoming(encode(notify_body(payload=payload)))
+    assert (tx.kind, tx.comment) == ('jetton', "")
+
+
+@pytest.mark.parametrize("custom_payload", [False, True])
+def test_jetton_transfer(custom_payload):
+    body = Builder().uint(main.OP_JETTON_TRANSFER, 32).uint(1, 64).coins(250).address(SENDER)
+    body.address(OWNER)
+    if custom_payload:
+        body.uint(1, 1).ref(Builder().uint(0xFFFF, 16))
+    else:
+        body.uint(0, 1)
+    body.coins(1).uint(1, 1).ref(comment_cell("payout"))
+    tx = outgoing(encode(body, with_index=True))
+    assert (tx.kind, tx.asset, tx.asset_amount) == ('jetton', JETTON_WALLET, 250)
+    assert (tx.direction, tx.source, tx.destination) == ('out', OWNER, SENDER)
+    assert tx.comment == "payout"
+
+
+def test_jetton_transfer_without_forward_payload():
+    body = Builder().uint(main.OP_JETTON_TRANSFER, 32).uint(1, 64).coins(5).address(SENDER)
+    body.address("").uint(0, 1).coins(0)
+    tx = outgoing(encode(body))
+    assert (tx.kind, tx.destination, tx.asset_amount, tx.comment) == ('jetton', SENDER, 5, "")
+
+
+def test_jetton_burn():
+    body = Builder().uint(main.OP_JETTON_BURN, 32).uint(9, 64).coins(777).address(OWNER).uint(0, 1)
+    tx = outgoing(encode(body))
+    assert (tx.kind, tx.asset, tx.asset_amount) == ('jetton_burn', JETTON_WALLET, 777)
+    assert tx.destination == JETTON_WALLET
+
+
+def test_nft_transfer():
+    body = Builder().uint(main.OP_NFT_TRANSFER, 32).uint(3, 64).address(SENDER).address(OWNER)
+    body.uint(0, 1).coins(1).uint(0, 1)
+    tx = outgoing(encode(body), destination=NFT_ITEM)
+    assert (tx.kind, tx.asset, tx.destination) == ('nft', NFT_ITEM, SENDER)
+
+
+def test_nft_ownership_assigned():
+    body = Builder().uint(main.OP_NFT_OWNERSHIP_ASSIGNED, 32).uint(3, 64).address(SENDER)
+    body.uint(1, 1).ref(comment_cell("подарок"))
+    tx = incoming(encode(body), source=NFT_ITEM)
+    assert (tx.kind, tx.asset, tx.source, tx.comment) == ('nft', NFT_ITEM, SENDER, "подарок")
+
+
+# Некорректные тела: обычный перевод TON без частичных изменений
+
+
+def assert_plain(tx, comment=""):
+    assert (tx.kind, tx.asset, tx.asset_amount) == ('', '', 0)
+    assert (tx.source, tx.destination, tx.amount) == (JETTON_WALLET, OWNER, 50000000)
+    assert tx.comment == comment
+
+
+@pytest.mark.parametrize("body", [
+    base64.b64encode(b"not a boc").decode(),
+    "!!!",
+    NOTIFY_BODY[:40],
+    base64.b64encode(base64.b64decode(NOTIFY_BODY)[:30]).decode(),
+])
+def test_malformed_boc_leaves_plain_transfer(body):
+    assert_plain(incoming(body))
+
+
+def test_truncated_notify_body_leaves_plain_transfer():
+    body = Builder().uint(main.OP_JETTON_NOTIFY, 32).uint(7, 64).coins(100).uint(2, 2).uint(0, 9)
+    assert_plain(incoming(encode(body)))
+
+
+def test_missing_forward_payload_ref_leaves_plain_transfer():
+    body = notify_body().bits[:-1] + "1"
+    cell = Builder()
+    cell.bits = body
+    assert_plain(incoming(encode(cell)))
+
+
+def test_unregistered_opcode_skips_body():
+    # Тело не разбирается вовсе - даже если оно не является BOC
+    assert_plain(incoming("!!!", opcode="0x12345678"))
+    assert_plain(incoming(encode(comment_cell("text")), opcode=0))
+
+
+def test_opcode_mismatch_uses_body():
+    # Подсказка opcode из API - только фильтр; обработчик выбирается по телу
+    tx = incoming(NOTIFY_BODY, opcode=main.OP_JETTON_BURN)
+    assert (tx.kind, tx.asset_amount, tx.comment) == ('jetton', 1500000, "hi")
+
+
+def test_short_body_is_ignored():
+    assert_plain(incoming(encode(Builder().uint(1, 16))))
+
+
+def test_transaction_row_round_trip():
+    tx = incoming(NOTIFY_BODY)
+    assert main.Transaction.from_stored(tx.to_row()) == tx
+    plain = incoming(None)
+    assert len(plain.to_row()) == 9
+    assert main.Transaction.from_stored(plain.to_row()) == plain